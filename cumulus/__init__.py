@@ -6,3 +6,6 @@ An interface to the python-swiftclient api through Django.
 from ._version import get_versions
 __version__ = get_versions()['version']
 del get_versions
+
+# Django < 1.7 ignores this
+default_app_config = "cumulus.apps.CumulusConfig"
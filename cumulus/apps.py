@@ -0,0 +1,49 @@
+import logging
+
+from django.apps import AppConfig
+
+from cumulus.settings import CUMULUS
+
+
+class CumulusConfig(AppConfig):
+    name = "cumulus"
+    verbose_name = "Cumulus"
+
+    def ready(self):
+        if CUMULUS["VERIFY_CONTAINERS"]:
+            self.verify_containers()
+        if CUMULUS["PRELOAD_CDN_URIS"]:
+            self.preload_cdn_uris()
+
+    def verify_containers(self):
+        """
+        Creates the configured containers if needed, so that the storages of
+        the process use them without any further check.
+        """
+        from cumulus.storage import CumulusStorage, CumulusStaticStorage
+
+        for storage_class in (CumulusStorage, CumulusStaticStorage):
+            if not storage_class.container_name:
+                continue
+            try:
+                storage_class().ensure_container()
+            except Exception:
+                logging.exception("Could not verify the %s container", storage_class.container_name)
+
+    def preload_cdn_uris(self):
+        """
+        Fills the registry of CDN URIs for the configured containers, so that
+        the first requests of the process need not look them up.
+        """
+        from cumulus.storage import CumulusStorage, CumulusStaticStorage
+
+        for storage_class in (CumulusStorage, CumulusStaticStorage):
+            if not storage_class.container_name or not storage_class.public:
+                continue
+            storage = storage_class()
+            try:
+                storage.container_cdn_uri
+                storage.container_cdn_ssl_uri
+            except Exception:
+                logging.exception("Could not preload the CDN URIs of the %s container",
+                                  storage.container_name)
@@ -1,5 +1,10 @@
+import datetime
+import hashlib
 import logging
 import pyrax
+import threading
+from contextlib import contextmanager
+from time import time
 try:
     import swiftclient
 except ImportError:
@@ -7,12 +12,152 @@ except ImportError:
 
 from django.utils.functional import cached_property
 from OpenSSL.SSL import Error
-from pyrax.exceptions import PyraxException
+from pyrax.exceptions import ClientException, PyraxException
+from pyrax.object_storage import Container
 from requests.exceptions import RequestException
 
+from cumulus.cache import get_django_cache, get_token_cache
 from cumulus.settings import CUMULUS
 
 
+# cached tokens are refreshed this many seconds before they expire
+TOKEN_EXPIRY_MARGIN = 300
+TOKEN_EXPIRY_FORMAT = "%Y-%m-%dT%H:%M:%S.000Z"
+
+
+class ConnectionPool(object):
+    """
+    A bounded pool of connections shared between threads.
+
+    A connection is checked out for the exclusive use of one thread and
+    returned when it is done, to be reused by the next one. At most
+    ``max_size`` connections exist at a time; beyond that ``checkout``
+    waits up to ``timeout`` seconds for one to be returned. Connections
+    left idle for more than ``idle_timeout`` seconds are dropped rather
+    than reused.
+    """
+    def __init__(self, create_connection, max_size, idle_timeout, timeout=None):
+        self.create_connection = create_connection
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = []  # (returned at, connection), most recently returned last
+        self._checked_out = 0
+        self._lock = threading.Lock()
+        self._returned = threading.Condition(self._lock)
+        self._held = threading.local()
+
+    def checkout(self):
+        """
+        Returns an idle connection, or a new one if none is left. Raises a
+        ``ClientException`` when none is returned within ``timeout`` seconds.
+        """
+        with self._lock:
+            deadline = None if self.timeout is None else time() + self.timeout
+            while self._checked_out >= self.max_size:
+                remaining = None if deadline is None else deadline - time()
+                if remaining is not None and remaining <= 0:
+                    raise ClientException(503, "No connection was returned to the pool "
+                                               "within {0} seconds".format(self.timeout))
+                self._returned.wait(remaining)
+            self._checked_out += 1
+            expired = time() - self.idle_timeout
+            while self._idle and self._idle[0][0] < expired:
+                self._idle.pop(0)
+            if self._idle:
+                return self._idle.pop()[1]
+        try:
+            return self.create_connection()
+        except Exception:
+            with self._lock:
+                self._checked_out -= 1
+                self._returned.notify()
+            raise
+
+    def checkin(self, connection):
+        """
+        Returns a checked out connection to the pool.
+        """
+        with self._lock:
+            self._idle.append((time(), connection))
+            self._checked_out -= 1
+            self._returned.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        Checks a connection out for the duration of a ``with`` block.
+        """
+        connection = self.checkout()
+        try:
+            yield connection
+        finally:
+            self.checkin(connection)
+
+    @contextmanager
+    def thread_connection(self):
+        """
+        Like ``connection``, but a thread already inside a
+        ``thread_connection`` block gets the connection it holds rather
+        than a second one. A request reading its body from another object
+        of the pool (say, copying a file between two storages) would
+        otherwise wait for a connection of its own.
+        """
+        connection = getattr(self._held, "connection", None)
+        if connection is not None:
+            yield connection
+            return
+        with self.connection() as connection:
+            self._held.connection = connection
+            try:
+                yield connection
+            finally:
+                self._held.connection = None
+
+
+class PooledConnection(object):
+    """
+    Stands in for a connection, making each method call on a connection
+    checked out of ``pool`` for the duration of the call.
+    """
+    def __init__(self, pool):
+        self._pool = pool
+
+    def __getattr__(self, name):
+        with self._pool.thread_connection() as connection:
+            attr = getattr(connection, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            with self._pool.thread_connection() as connection:
+                return getattr(connection, name)(*args, **kwargs)
+        return call
+
+
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+_authentication_lock = threading.Lock()
+
+# containers known to exist, by (region, container name)
+_existing_containers = set()
+_existing_containers_lock = threading.Lock()
+
+# CDN URIs of the containers, by (region, container name, ssl)
+_cdn_uris = {}
+_cdn_uris_lock = threading.Lock()
+
+
+def _get_cdn_uri_cache():
+    if CUMULUS["CDN_URI_CACHE"]:
+        return get_django_cache(CUMULUS["CDN_URI_CACHE"])
+    return None
+
+
+def _make_cdn_uri_key(key):
+    return "cumulus:cdn_uri:{0}".format(hashlib.md5(u"{0}/{1}/{2}".format(*key).encode("utf-8")).hexdigest())
+
+
 class Auth(object):
     connection_kwargs = {}
     use_pyrax = CUMULUS["USE_PYRAX"]
@@ -40,7 +185,7 @@ class Auth(object):
         if connection_kwargs is not None:
             self.connection_kwargs = connection_kwargs
 
-        # connect
+        # authentication is deferred until the first connection is made
         if self.use_pyrax:
             self.pyrax = pyrax
             if self.pyrax_identity_type:
@@ -50,8 +195,18 @@ class Auth(object):
             if self.auth_tenant_id:
                 self.pyrax.set_setting("tenant_id", self.auth_tenant_id)
             self.pyrax.set_setting("region", self.region)
+        # else:
+        #     headers = {"X-Container-Read": ".r:*"}
+        #     self._connection.post_container(self.container_name, headers=headers)
+
+    def _connect(self):
+        """
+        Authenticates pyrax unless it already holds a valid token for these
+        credentials. Errors are logged; the connection fails afterwards.
+        """
+        with _authentication_lock:
             try:
-                self.pyrax.set_credentials(self.username, self.api_key)
+                self._authenticate()
             except (Error, PyraxException, RequestException) as e:
                 logging.warning('Error in pyrax.set_credentials, %s: %s', e.__class__.__name__, str(e))
             except Exception as e:
@@ -59,26 +214,102 @@ class Auth(object):
                     """Pyrax Connect Error in `django_cumulus.cumulus.authentication.Auth`::
                            self.pyrax.set_credentials(self.username, self.api_key)
                     """)
-        # else:
-        #     headers = {"X-Container-Read": ".r:*"}
-        #     self._connection.post_container(self.container_name, headers=headers)
+
+    def _authenticate(self):
+        """
+        Authenticates pyrax's identity, reusing the token and service catalog
+        kept by TOKEN_CACHE while they are valid. Only one process at a time
+        asks the identity service for a new token; the others wait for it
+        and use the token it cached.
+        """
+        identity = self.pyrax.identity
+        if (identity is not None and identity.authenticated and
+                identity.username == self.username and self._token_is_fresh(identity.expires)):
+            return
+        token_cache = get_token_cache(self.auth_url, self.auth_tenant_id, self.username)
+        if token_cache is None:
+            self.pyrax.set_credentials(self.username, self.api_key)
+            return
+        access = token_cache.get()
+        if access is None or not self._token_is_fresh(self._parse_token_expiry(access)):
+            with token_cache.lock():
+                access = token_cache.get()
+                if access is None or not self._token_is_fresh(self._parse_token_expiry(access)):
+                    self.pyrax.set_credentials(self.username, self.api_key)
+                    access = self._dump_identity(self.pyrax.identity)
+                    ttl = self.pyrax.identity.expires - datetime.datetime.utcnow()
+                    token_cache.set(access, max(ttl.days * 86400 + ttl.seconds - TOKEN_EXPIRY_MARGIN, 1))
+                    return
+        self._load_identity(access)
+
+    def _token_is_fresh(self, expires):
+        margin = datetime.timedelta(seconds=TOKEN_EXPIRY_MARGIN)
+        return expires is not None and expires > datetime.datetime.utcnow() + margin
+
+    def _parse_token_expiry(self, access):
+        try:
+            return datetime.datetime.strptime(access["access"]["token"]["expires"], TOKEN_EXPIRY_FORMAT)
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def _dump_identity(self, identity):
+        """
+        Returns the access data of an authenticated identity, in the form
+        of the identity service's response.
+        """
+        user = dict(identity.user)
+        default_region = getattr(identity, "_default_region", None)
+        if default_region:
+            user["RAX-AUTH:defaultRegion"] = default_region
+        return {"access": {
+            "token": {
+                "id": identity.token,
+                "expires": identity.expires.strftime(TOKEN_EXPIRY_FORMAT),
+                "tenant": {"id": identity.tenant_id, "name": identity.tenant_name},
+            },
+            "serviceCatalog": identity.service_catalog,
+            "user": user,
+        }}
+
+    def _load_identity(self, access):
+        """
+        Authenticates pyrax's identity with cached access data, without
+        calling the identity service.
+        """
+        if self.pyrax.identity is None:
+            self.pyrax.identity = self.pyrax.create_context()
+        identity = self.pyrax.identity
+        # kept so that pyrax can authenticate again when the token is revoked
+        identity.set_credentials(self.username, self.api_key,
+                                 tenant_id=self.pyrax.get_setting("tenant_id"))
+        identity._parse_response(access)
+        identity.authenticated = True
+        self.pyrax.regions = tuple(identity.regions)
+        self.pyrax.services = tuple(identity.services.keys())
+
+    def _create_connection(self):
+        """
+        Returns a new connection to the cloud.
+        """
+        if self.use_pyrax:
+            self._connect()
+            public = not self.use_snet  # invert
+            return pyrax.connect_to_cloudfiles(public=public)
+        elif swiftclient:
+            return swiftclient.Connection(
+                authurl=self.auth_url,
+                user=self.username,
+                key=self.api_key,
+                snet=self.use_snet,
+                auth_version=self.auth_version,
+                tenant_name=self.auth_tenant_name,
+            )
+        else:
+            raise NotImplementedError("Cloud connection is not correctly configured.")
 
     def _get_connection(self):
         if not hasattr(self, "_connection"):
-            if self.use_pyrax:
-                public = not self.use_snet  # invert
-                self._connection = pyrax.connect_to_cloudfiles(public=public)
-            elif swiftclient:
-                self._connection = swiftclient.Connection(
-                    authurl=self.auth_url,
-                    user=self.username,
-                    key=self.api_key,
-                    snet=self.use_snet,
-                    auth_version=self.auth_version,
-                    tenant_name=self.auth_tenant_name,
-                )
-            else:
-                raise NotImplementedError("Cloud connection is not correctly configured.")
+            self._connection = self._create_connection()
         return self._connection
 
     def _set_connection(self, value):
@@ -86,6 +317,22 @@ class Auth(object):
 
     connection = property(_get_connection, _set_connection)
 
+    @property
+    def connection_pool(self):
+        """
+        The pool of connections shared by all the instances of the process
+        with the same settings.
+        """
+        key = (self.use_pyrax, self.use_snet, self.region, self.auth_url, self.auth_version,
+               self.auth_tenant_id, self.auth_tenant_name, self.username, self.api_key)
+        with _connection_pools_lock:
+            if key not in _connection_pools:
+                _connection_pools[key] = ConnectionPool(self._create_connection,
+                                                        CUMULUS["CONNECTION_POOL_SIZE"],
+                                                        CUMULUS["CONNECTION_IDLE_TIMEOUT"],
+                                                        CUMULUS["CONNECTION_POOL_TIMEOUT"])
+            return _connection_pools[key]
+
     def __getstate__(self):
         """
         Return a picklable representation of the storage.
@@ -98,13 +345,37 @@ class Auth(object):
             "connection_kwargs": self.connection_kwargs
         }
 
+    def ensure_container(self, name=None):
+        """
+        Creates the container called ``name`` (by default the storage's one)
+        unless this process already knows it exists.
+        """
+        name = name or self.container_name
+        key = (self.region, name)
+        with _existing_containers_lock:
+            if key in _existing_containers:
+                return None
+        if self.use_pyrax:
+            container = self.connection.create_container(name)
+        else:
+            container = self.connection.put_container(name)
+        with _existing_containers_lock:
+            _existing_containers.add(key)
+        return container
+
     def _get_container(self):
         """
-        Gets or creates the container.
+        Gets or creates the container. Once it is known to exist, or with
+        ASSUME_CONTAINERS_EXIST, a handle is returned without any request.
         """
         if not hasattr(self, "_container"):
             if self.use_pyrax:
-                self._container = self.connection.create_container(self.container_name)
+                container = None
+                if not CUMULUS["ASSUME_CONTAINERS_EXIST"]:
+                    container = self.ensure_container()
+                if container is None:
+                    container = Container(self.connection._manager, {"name": self.container_name})
+                self._container = container
             else:
                 self._container = None
         return self._container
@@ -129,12 +400,55 @@ class Auth(object):
 
         return CUMULUS['CNAMES'][uri]
 
+    def _get_cdn_uri(self, ssl):
+        """
+        Returns the CDN URI of the container from the registry shared by the
+        instances of the process. The first time it is read from the
+        CDN_URI_CACHE, or else from the container.
+        """
+        key = (self.region, self.container_name, ssl)
+        with _cdn_uris_lock:
+            uri = _cdn_uris.get(key)
+        if uri is None:
+            cache = _get_cdn_uri_cache()
+            if cache is not None:
+                uri = cache.get(_make_cdn_uri_key(key))
+            if uri is None:
+                return self._lookup_cdn_uri(ssl)
+            with _cdn_uris_lock:
+                _cdn_uris[key] = uri
+        return uri
+
+    def _lookup_cdn_uri(self, ssl):
+        """
+        Reads the CDN URI of the container and keeps it in the registry and
+        in the CDN_URI_CACHE.
+        """
+        uri = self.container.cdn_ssl_uri if ssl else self.container.cdn_uri
+        key = (self.region, self.container_name, ssl)
+        with _cdn_uris_lock:
+            _cdn_uris[key] = uri
+        cache = _get_cdn_uri_cache()
+        if cache is not None:
+            cache.set(_make_cdn_uri_key(key), uri, CUMULUS["CDN_URL_REFRESH"])
+        return uri
+
+    def refresh_cdn_uris(self):
+        """
+        Reads the CDN URIs of the container again, for the instances created
+        from now on.
+        """
+        if not self.container_uri:
+            self._lookup_cdn_uri(False)
+        if not self.container_ssl_uri:
+            self._lookup_cdn_uri(True)
+
     @cached_property
     def container_cdn_ssl_uri(self):
         if self.container_ssl_uri:
             uri = self.container_ssl_uri
         else:
-            uri = self.container.cdn_ssl_uri
+            uri = self._get_cdn_uri(True)
 
         return self.get_cname(uri)
 
@@ -143,7 +457,7 @@ class Auth(object):
         if self.container_uri:
             uri = self.container_uri
         else:
-            uri = self.container.cdn_uri
+            uri = self._get_cdn_uri(False)
 
         return self.get_cname(uri)
 
@@ -0,0 +1,238 @@
+"""
+Caches of object metadata, which spare the HEAD requests behind
+``exists()`` and ``size()``, and of the identity token, which spare
+authenticating in every process.
+
+Metadata entries are ``CloudObject`` records, or False for objects known
+not to exist; ``get`` returns None for unknown or expired entries.
+"""
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import stat
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from time import sleep, time
+
+from cumulus.settings import CUMULUS
+
+
+class LRUMetadataCache(object):
+    """
+    A thread-safe cache local to the process, holding at most
+    ``max_entries`` entries and evicting the least recently used first.
+    """
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, container, name):
+        key = (container, name)
+        with self._lock:
+            try:
+                expires, value = self._entries.pop(key)
+            except KeyError:
+                return None
+            if expires < time():
+                return None
+            # move to the most recently used end
+            self._entries[key] = (expires, value)
+            return value
+
+    def set(self, container, name, value):
+        key = (container, name)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time() + self.ttl, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, container, name):
+        with self._lock:
+            self._entries.pop((container, name), None)
+
+
+def get_django_cache(alias):
+    """
+    Returns the cache of Django's CACHES setting called ``alias``.
+    """
+    try:
+        from django.core.cache import caches
+        return caches[alias]
+    except ImportError:
+        # Django < 1.7
+        from django.core.cache import get_cache
+        return get_cache(alias)
+
+
+class DjangoMetadataCache(object):
+    """
+    A cache kept in one of the caches of Django's CACHES setting, which can
+    be shared between processes.
+    """
+    def __init__(self, ttl, alias="default"):
+        self.cache = get_django_cache(alias)
+        self.ttl = ttl
+
+    def make_key(self, container, name):
+        # object names can be longer than memcached keys, or contain spaces
+        path = u"{0}/{1}".format(container, name).encode("utf-8")
+        return "cumulus:metadata:{0}".format(hashlib.md5(path).hexdigest())
+
+    def get(self, container, name):
+        return self.cache.get(self.make_key(container, name))
+
+    def set(self, container, name, value):
+        self.cache.set(self.make_key(container, name), value, self.ttl)
+
+    def delete(self, container, name):
+        self.cache.delete(self.make_key(container, name))
+
+
+_metadata_cache = None
+_metadata_cache_lock = threading.Lock()
+
+
+def get_metadata_cache():
+    """
+    Returns the process wide cache configured by METADATA_CACHE: None when
+    it is disabled, an LRU cache for "locmem", and otherwise the Django
+    cache of that alias.
+    """
+    global _metadata_cache
+    backend = CUMULUS["METADATA_CACHE"]
+    if not backend:
+        return None
+    with _metadata_cache_lock:
+        if _metadata_cache is None:
+            if backend == "locmem":
+                _metadata_cache = LRUMetadataCache(CUMULUS["METADATA_CACHE_TTL"],
+                                                   CUMULUS["METADATA_CACHE_SIZE"])
+            else:
+                _metadata_cache = DjangoMetadataCache(CUMULUS["METADATA_CACHE_TTL"], backend)
+        return _metadata_cache
+
+
+def is_private(st):
+    """
+    Returns whether the ``os.stat`` result ``st`` belongs to the current
+    user and grants no permission to anyone else.
+    """
+    return st.st_uid == os.getuid() and not st.st_mode & (stat.S_IRWXG | stat.S_IRWXO)
+
+
+def get_private_dir(path):
+    """
+    Creates the directory ``path``, accessible to the current user only,
+    unless it exists. Returns ``path``, or None when it is not such a
+    directory.
+    """
+    try:
+        os.mkdir(path, 0o700)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or not is_private(st):
+        logging.warning("Not caching tokens in %s, which other users can access", path)
+        return None
+    return path
+
+
+class FileTokenCache(object):
+    """
+    Keeps the identity's access data in a JSON file readable by its owner
+    only, in a directory private to that owner. Refreshes are serialized
+    with a lock on a file next to it.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def get(self):
+        try:
+            with open(self.path) as f:
+                # a token planted by someone else could send the uploads anywhere
+                if not is_private(os.fstat(f.fileno())):
+                    logging.warning("Ignoring %s, which other users can access", self.path)
+                    return None
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def set(self, access, ttl):
+        # written to a private temporary file, then renamed over the old one
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path))
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(access, f)
+            os.rename(tmp_path, self.path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    @contextmanager
+    def lock(self):
+        fd = os.open(u"{0}.lock".format(self.path), os.O_WRONLY | os.O_CREAT, 0o600)
+        with os.fdopen(fd, "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class DjangoTokenCache(object):
+    """
+    Keeps the identity's access data in one of the caches of Django's
+    CACHES setting. Refreshes are serialized with a key added to the cache,
+    given up on after ``lock_timeout`` seconds.
+    """
+    def __init__(self, key, alias="default", lock_timeout=30):
+        self.cache = get_django_cache(alias)
+        self.key = "cumulus:token:{0}".format(key)
+        self.lock_timeout = lock_timeout
+
+    def get(self):
+        return self.cache.get(self.key)
+
+    def set(self, access, ttl):
+        self.cache.set(self.key, access, ttl)
+
+    @contextmanager
+    def lock(self):
+        lock_key = "{0}:lock".format(self.key)
+        deadline = time() + self.lock_timeout
+        while not self.cache.add(lock_key, 1, self.lock_timeout) and time() < deadline:
+            sleep(0.1)
+        try:
+            yield
+        finally:
+            self.cache.delete(lock_key)
+
+
+def get_token_cache(*credentials):
+    """
+    Returns the cache configured by TOKEN_CACHE for the token of the given
+    credentials: None when it is disabled, a file in TOKEN_CACHE_DIR (by
+    default a directory of the current user in the system's temporary
+    directory) for "file", and otherwise the Django cache of that alias.
+    The directory must be accessible to the current user only.
+    """
+    backend = CUMULUS["TOKEN_CACHE"]
+    if not backend:
+        return None
+    key = hashlib.md5(u"\n".join(u"{0}".format(c) for c in credentials).encode("utf-8")).hexdigest()
+    if backend == "file":
+        token_dir = get_private_dir(CUMULUS["TOKEN_CACHE_DIR"] or os.path.join(
+            tempfile.gettempdir(), "cumulus-{0}".format(os.getuid())))
+        if token_dir is None:
+            return None
+        return FileTokenCache(os.path.join(token_dir, "cumulus-token-{0}.json".format(key)))
+    return DjangoTokenCache(key, backend)
@@ -1,26 +1,71 @@
+import logging
+import threading
+from time import time
 from urlparse import urlparse
 
 from django.conf import settings
 
+from cumulus.settings import CUMULUS
 from cumulus.storage import CumulusStorage, CumulusStaticStorage
 
 
+# the CDN URLs of each storage class, with the time they were resolved
+_container_urls = {}
+_container_urls_lock = threading.Lock()
+_refreshing = set()
+
+
 def _is_ssl_uri(uri):
     return urlparse(uri).scheme == "https"
 
 
-def _get_container_urls(swiftclient_storage):
-    cdn_url = swiftclient_storage.container.cdn_uri
-    ssl_url = swiftclient_storage.container.cdn_ssl_uri
+def _resolve_container_urls(storage_class, refresh=False):
+    storage = storage_class()
+    if refresh:
+        storage.refresh_cdn_uris()
+    urls = storage.container_cdn_uri, storage.container_cdn_ssl_uri
+    with _container_urls_lock:
+        _container_urls[storage_class] = (time(), urls)
+    return urls
+
+
+def _refresh_container_urls(storage_class):
+    try:
+        _resolve_container_urls(storage_class, refresh=True)
+    except Exception:
+        logging.exception("Could not refresh the CDN URLs of %s", storage_class.__name__)
+    finally:
+        with _container_urls_lock:
+            _refreshing.discard(storage_class)
 
-    return cdn_url, ssl_url
+
+def _get_container_urls(storage_class):
+    """
+    Returns the CDN URLs of the container of ``storage_class``, resolved
+    once per process. Once they are older than CDN_URL_REFRESH seconds
+    they are refreshed in a background thread, while the known ones keep
+    being returned.
+    """
+    with _container_urls_lock:
+        resolved_at, urls = _container_urls.get(storage_class, (None, None))
+        refresh = (urls is not None and storage_class not in _refreshing and
+                   time() - resolved_at > CUMULUS["CDN_URL_REFRESH"])
+        if refresh:
+            _refreshing.add(storage_class)
+    if urls is None:
+        return _resolve_container_urls(storage_class)
+    if refresh:
+        thread = threading.Thread(target=_refresh_container_urls, args=(storage_class,))
+        thread.daemon = True
+        thread.start()
+    return urls
 
 
 def cdn_url(request):
     """
     A context processor that exposes the full CDN URL in templates.
     """
-    cdn_url, ssl_url = _get_container_urls(CumulusStorage())
+    cdn_url, ssl_url = _get_container_urls(CumulusStorage)
     static_url = settings.STATIC_URL
 
     return {
@@ -34,7 +79,7 @@ def static_cdn_url(request):
     A context processor that exposes the full static CDN URL
     as static URL in templates.
     """
-    cdn_url, ssl_url = _get_container_urls(CumulusStaticStorage())
+    cdn_url, ssl_url = _get_container_urls(CumulusStaticStorage)
     static_url = settings.STATIC_URL
 
     return {
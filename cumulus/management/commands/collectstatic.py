@@ -12,13 +12,10 @@ class Command(collectstatic.Command):
         Checks if the target file should be deleted if it already exists
         """
         if isinstance(self.storage, CumulusStorage):
-            if self.storage.exists(prefixed_path):
-                try:
-                    etag = self.storage._get_object(prefixed_path).etag
-                    digest = "{0}".format(hashlib.md5(source_storage.open(path).read()).hexdigest())
-                    if etag == digest:
-                        self.log(u"Skipping '{0}' (not modified based on file hash)".format(path))
-                        return False
-                except:
-                    raise
+            cloud_obj = self.storage._get_object_info(prefixed_path)
+            if cloud_obj:
+                digest = "{0}".format(hashlib.md5(source_storage.open(path).read()).hexdigest())
+                if cloud_obj.hash == digest:
+                    self.log(u"Skipping '{0}' (not modified based on file hash)".format(path))
+                    return False
         return super(Command, self).delete_file(path, prefixed_path, source_storage)
@@ -1,6 +1,6 @@
 from django.core.management.base import BaseCommand, CommandError
 
-from cumulus.authentication import Auth
+from cumulus.storage import CumulusStorage
 
 
 class Command(BaseCommand):
@@ -22,9 +22,10 @@ class Command(BaseCommand):
                 raise CommandError("Aborted")
 
         print("Connecting")
-        self._connection = Auth()._get_connection()
+        storage = CumulusStorage(container=container_name)
+        self._connection = storage.connection
         container = self._connection.get_container(container_name)
         print("Deleting objects from container {0}".format(container_name))
-        container.delete_all_objects()
+        storage.delete_many(cloud_obj.name for cloud_obj in storage.iter_objects())
         container.delete()
         print("Deletion complete")
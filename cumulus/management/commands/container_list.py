@@ -1,6 +1,7 @@
 from django.core.management.base import BaseCommand, CommandError
 
 from cumulus.authentication import Auth
+from cumulus.storage import CumulusStorage
 
 
 class Command(BaseCommand):
@@ -18,14 +19,19 @@ class Command(BaseCommand):
 
         if len(args) == 0:
             containers = self._connection.list_containers()
-            if not containers:
-                print("No containers were found for this account.")
+            not_found = "No containers were found for this account."
         elif len(args) == 1:
-            containers = self._connection.list_container_object_names(args[0])
-            if not containers:
-                print("No matching container found.")
+            # stream the object names page by page, however many there are
+            storage = CumulusStorage(container=args[0])
+            storage.connection = self._connection
+            containers = (cloud_obj.name for cloud_obj in storage.iter_objects())
+            not_found = "No matching container found."
         else:
             raise CommandError("Pass one and only one [container_name] as an argument")
 
+        found = False
         for container in containers:
+            found = True
             print(container)
+        if not found:
+            print(not_found)
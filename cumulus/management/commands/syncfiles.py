@@ -1,15 +1,81 @@
 import datetime
 import fnmatch
+import hashlib
+import json
 import os
 import re
+import tarfile
+import tempfile
+import threading
+from collections import OrderedDict
+from multiprocessing import Pool
 
 from django.conf import settings
 from django.core.management.base import CommandError, BaseCommand
 
 
-from cumulus.authentication import Auth
 from cumulus.settings import CUMULUS
-from cumulus.storage import get_headers, get_content_type, get_gzipped_contents
+from cumulus.storage import (CloudObject, ThreadSafeCumulusStorage, GzipStream, get_headers,
+                             get_content_type, run_in_threads, stream_content)
+
+
+# the most bytes of files put in a single archive by --bulk-archive
+ARCHIVE_BATCH_SIZE = 104857600  # 100MB
+
+# local files starting with this are sync manifests and never uploaded
+MANIFEST_PREFIX = ".cumulus-manifest-"
+
+
+def hash_file(job):
+    """
+    Returns the relative path and MD5 hex digest of a local file, as it
+    would be uploaded: gzipped first if ``gzipped`` is set. Kept at module
+    level so that it can run in a process pool.
+    """
+    relpath, abspath, gzipped = job
+    checksum = hashlib.md5()
+    with open(abspath, "rb") as content:
+        if gzipped:
+            content = GzipStream(content)
+        for _ in stream_content(content, CUMULUS["CHUNK_SIZE"], checksum):
+            pass
+    return relpath, checksum.hexdigest()
+
+
+class ArchiveBuffer(object):
+    """
+    A write-only file-like object collecting the output of a tar stream
+    until it is drained.
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_tar(files):
+    """
+    Yields a gzipped tar archive of ``files``, ``(abspath, arcname)`` pairs,
+    while it is being written, holding about one file's worth of it in
+    memory at a time.
+    """
+    buf = ArchiveBuffer()
+    archive = tarfile.open(fileobj=buf, mode="w|gz", dereference=True)
+    for abspath, arcname in files:
+        archive.add(abspath, arcname=arcname, recursive=False)
+        data = buf.drain()
+        if data:
+            yield data
+    archive.close()
+    data = buf.drain()
+    if data:
+        yield data
 
 
 class Command(BaseCommand):
@@ -41,6 +107,20 @@ class Command(BaseCommand):
         parser.add_argument("-m", "--media",
                              action="store_true", dest="syncmedia", default=False,
                              help="Sync media files located at settings.MEDIA_ROOT path."),
+        parser.add_argument("--workers", type=int, dest="workers", default=1,
+                             help="Number of files to upload concurrently. Defaults to 1."),
+        parser.add_argument("--compare", choices=["mtime", "hash"], dest="compare",
+                             default="mtime",
+                             help="Decide which files changed by modification time or by "
+                                  "MD5 hash. Defaults to mtime."),
+        parser.add_argument("--rebuild-manifest",
+                             action="store_true", dest="rebuild_manifest", default=False,
+                             help="Ignore the manifest of the last run and compare every "
+                                  "file with a full listing of the container."),
+        parser.add_argument("--bulk-archive",
+                             action="store_true", dest="bulk_archive", default=False,
+                             help="Upload files in gzipped tar archives that the cluster "
+                                  "extracts, instead of one request per file."),
 
     def set_options(self, options):
         """
@@ -54,6 +134,10 @@ class Command(BaseCommand):
         self.verbosity = int(options.get("verbosity"))
         self.syncmedia = options.get("syncmedia")
         self.syncstatic = options.get("syncstatic")
+        self.workers = max(int(options.get("workers") or 1), 1)
+        self.compare = options.get("compare") or "mtime"
+        self.rebuild_manifest = options.get("rebuild_manifest")
+        self.bulk_archive = options.get("bulk_archive")
         if self.test_run:
             self.verbosity = 2
         cli_includes = options.get("includes")
@@ -83,6 +167,8 @@ class Command(BaseCommand):
             self.file_root = self.file_root + "/"
         if self.file_url.startswith("/"):
             self.file_url = self.file_url[1:]
+        self.manifest_path = os.path.join(CUMULUS["MANIFEST_DIR"] or self.file_root,
+                                          "{0}{1}.json".format(MANIFEST_PREFIX, self.container_name))
 
         # SYNCSTATIC VARS
         # combine includes and excludes from the cli and django settings file
@@ -95,12 +181,18 @@ class Command(BaseCommand):
         self.update_count = 0
         self.skip_count = 0
         self.delete_count = 0
+        self.failures = []
+        self.lock = threading.Lock()
+        self.manifest = {}
+        self.local_stats = {}
+        self.local_hashes = {}
+        self.uploaded = {}
 
-    def handle_noargs(self, *args, **options):
+    def handle(self, *args, **options):
         # setup
         self.set_options(options)
-        self._connection = Auth()._get_connection()
-        self.container = self._connection.get_container(self.container_name)
+        # one connection per worker thread
+        self.storage = ThreadSafeCumulusStorage(container=self.container_name)
 
         # wipe first
         if self.wipe:
@@ -108,14 +200,9 @@ class Command(BaseCommand):
 
         # match local files
         abspaths = self.match_local(self.file_root, self.includes, self.excludes)
-        relpaths = []
-        for path in abspaths:
-            filename = path.split(self.file_root)[1]
-            if filename.startswith("/"):
-                filename = filename[1:]
-            relpaths.append(filename)
+        local_files = self.index_local(abspaths)
 
-        if not relpaths:
+        if not local_files:
             settings_root_prefix = "MEDIA" if self.syncmedia else "STATIC"
             raise CommandError("The {0}_ROOT directory is empty "
                                "or all files have been ignored.".format(settings_root_prefix))
@@ -124,136 +211,341 @@ class Command(BaseCommand):
             if not os.path.isfile(path):
                 raise CommandError("Unsupported filetype: {0}.".format(path))
 
-        # match cloud objects
-        cloud_objs = self.match_cloud(self.includes, self.excludes)
-
-        remote_objects = {
-            obj.name: datetime.datetime.strptime(
-                obj.last_modified,
-                "%Y-%m-%dT%H:%M:%S.%f") for obj in self.container.get_objects()
-        }
+        # match cloud objects, trusting the manifest of the last run if any
+        self.manifest = self.load_manifest()
+        if self.manifest:
+            cloud_objects = self.index_manifest()
+        else:
+            cloud_objects = self.index_cloud()
+        cloud_objs = self.match_cloud(self.includes, self.excludes, cloud_objects)
 
         # sync
-        self.upload_files(abspaths, relpaths, remote_objects)
-        self.delete_extra_files(relpaths, cloud_objs)
+        self.upload_files(local_files, cloud_objects)
+        self.delete_extra_files(local_files, cloud_objs)
+        if not self.test_run and not self.failures:
+            self.save_manifest(local_files, cloud_objects)
 
         if not self.quiet or self.verbosity > 1:
             self.print_tally()
+        if self.failures:
+            self.print_failures()
+            raise CommandError("{0} files failed to upload.".format(len(self.failures)))
+
+    def index_cloud(self):
+        """
+        Lists the container in a single paginated pass and returns an
+        ordered dict of ``CloudObject`` records keyed by object name.
+        """
+        cloud_objects = OrderedDict()
+        for cloud_obj in self.storage.iter_objects():
+            cloud_objects[cloud_obj.name] = cloud_obj
+        return cloud_objects
+
+    def load_manifest(self):
+        """
+        Returns the files recorded by the last successful sync to this
+        container, or an empty dict if there is no usable manifest.
+        """
+        if self.rebuild_manifest or self.wipe:
+            return {}
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if manifest.get("container") != self.container_name:
+            return {}
+        return manifest.get("files", {})
 
-    def match_cloud(self, includes, excludes):
+    def save_manifest(self, local_files, cloud_objects):
         """
-        Returns the cloud objects that match the include and exclude patterns.
+        Atomically replaces the manifest with the size, mtime, MD5 and remote
+        ETag of every local file, now that they are all in sync.
         """
-        cloud_objs = [cloud_obj.name for cloud_obj in self.container.get_objects()]
-        includes_pattern = r"|".join([fnmatch.translate(x) for x in includes])
-        excludes_pattern = r"|".join([fnmatch.translate(x) for x in excludes]) or r"$."
-        excludes = [o for o in cloud_objs if re.match(excludes_pattern, o)]
-        includes = [o for o in cloud_objs if re.match(includes_pattern, o)]
-        return [o for o in includes if o not in excludes]
+        files = {}
+        for relpath in local_files:
+            stat = self.local_stats[relpath]
+            if relpath in self.uploaded:
+                etag = self.uploaded[relpath]
+                md5 = self.local_hashes.get(relpath) or etag
+            else:
+                etag = cloud_objects[relpath].hash
+                md5 = self.local_hashes.get(relpath) or self.manifest.get(relpath, {}).get("md5")
+            files[relpath] = {"size": stat.st_size, "mtime": stat.st_mtime,
+                              "md5": md5, "etag": etag}
+
+        manifest_dir = os.path.dirname(self.manifest_path)
+        fd, tmp_path = tempfile.mkstemp(prefix=MANIFEST_PREFIX, dir=manifest_dir)
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({"container": self.container_name, "files": files}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, self.manifest_path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def index_manifest(self):
+        """
+        Returns ``CloudObject`` records for the files in the manifest, in
+        place of a container listing.
+        """
+        cloud_objects = OrderedDict()
+        for name in sorted(self.manifest):
+            entry = self.manifest[name]
+            cloud_objects[name] = CloudObject(name, None, entry["size"], entry["etag"], None)
+        return cloud_objects
+
+    def match_cloud(self, includes, excludes, cloud_objects):
+        """
+        Returns the names of the indexed cloud objects that match the include
+        and exclude patterns.
+        """
+        cloud_objs = cloud_objects.keys()
+        includes_re = re.compile(r"|".join([fnmatch.translate(x) for x in includes]))
+        excludes_re = re.compile(r"|".join([fnmatch.translate(x) for x in excludes]) or r"$.")
+        return [o for o in cloud_objs if includes_re.match(o) and not excludes_re.match(o)]
 
     def match_local(self, prefix, includes, excludes):
         """
         Filters os.walk() with include and exclude patterns.
         See: http://stackoverflow.com/a/5141829/93559
         """
-        includes_pattern = r"|".join([fnmatch.translate(x) for x in includes])
-        excludes_pattern = r"|".join([fnmatch.translate(x) for x in excludes]) or r"$."
+        includes_re = re.compile(r"|".join([fnmatch.translate(x) for x in includes]))
+        excludes_re = re.compile(r"|".join([fnmatch.translate(x) for x in excludes]) or r"$.")
         matches = []
         for root, dirs, files in os.walk(prefix, topdown=True):
             # exclude dirs
             dirs[:] = [os.path.join(root, d) for d in dirs]
-            dirs[:] = [d for d in dirs if not re.match(excludes_pattern,
-                                                       d.split(root)[1])]
+            dirs[:] = [d for d in dirs if not excludes_re.match(d.split(root)[1])]
             # exclude/include files
             files = [os.path.join(root, f) for f in files]
-            files = [os.path.join(root, f) for f in files
-                     if not re.match(excludes_pattern, f)]
-            files = [os.path.join(root, f) for f in files
-                     if re.match(includes_pattern, f.split(prefix)[1])]
-            for fname in files:
-                matches.append(fname)
+            files = [f for f in files if not excludes_re.match(f)]
+            files = [f for f in files if includes_re.match(f.split(prefix)[1])]
+            matches.extend(files)
         return matches
 
-    def upload_files(self, abspaths, relpaths, remote_objects):
+    def index_local(self, abspaths):
         """
-        Determines files to be uploaded and call ``upload_file`` on each.
+        Returns an ordered dict of the local files keyed by their path
+        relative to the file root, which is also their cloud object name.
         """
-        for relpath in relpaths:
-            abspath = [p for p in abspaths if p[len(self.file_root):] == relpath][0]
-            cloud_datetime = remote_objects[relpath] if relpath in remote_objects else None
-            local_datetime = datetime.datetime.utcfromtimestamp(os.stat(abspath).st_mtime)
+        local_files = OrderedDict()
+        for abspath in abspaths:
+            if os.path.basename(abspath).startswith(MANIFEST_PREFIX):
+                continue
+            local_files[abspath[len(self.file_root):]] = abspath
+        return local_files
 
-            if cloud_datetime and local_datetime < cloud_datetime:
+    def upload_files(self, local_files, cloud_objects):
+        """
+        Determines files to be uploaded and call ``upload_file`` on each,
+        using ``self.workers`` threads. Failed uploads are collected in
+        ``self.failures`` rather than aborting the run.
+        """
+        # files whose size and mtime match the manifest are trusted as is
+        trusted = set()
+        for relpath, abspath in local_files.items():
+            stat = self.local_stats[relpath] = os.stat(abspath)
+            entry = self.manifest.get(relpath)
+            if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+                trusted.add(relpath)
+
+        if self.compare == "hash":
+            self.local_hashes = self.hash_local_files(
+                [(relpath, abspath) for relpath, abspath in local_files.items()
+                 if relpath in cloud_objects and relpath not in trusted])
+
+        uploads = []
+        for relpath, abspath in local_files.items():
+            cloud_obj = cloud_objects.get(relpath)
+            if relpath in trusted:
+                unchanged = True
+            elif not cloud_obj:
+                unchanged = False
+            elif self.compare == "hash":
+                unchanged = self.local_hashes[relpath] == cloud_obj.hash
+            elif cloud_obj.last_modified is None:
+                # only known from the manifest, and modified since
+                unchanged = False
+            else:
+                cloud_datetime = datetime.datetime.strptime(
+                    cloud_obj.last_modified, "%Y-%m-%dT%H:%M:%S.%f")
+                local_datetime = datetime.datetime.utcfromtimestamp(
+                    self.local_stats[relpath].st_mtime)
+                unchanged = local_datetime < cloud_datetime
+
+            if unchanged:
                 self.skip_count += 1
                 if not self.quiet:
                     print("Skipped {0}: not modified.".format(relpath))
                 continue
-            if relpath in remote_objects:
+            if cloud_obj:
                 self.update_count += 1
             else:
                 self.create_count += 1
-            self.upload_file(abspath, relpath)
+            uploads.append((abspath, relpath))
+
+        if self.bulk_archive and not self.test_run:
+            uploads = self.upload_archives(uploads)
+
+        def upload(paths):
+            self.upload_file(*paths)
+
+        self.failures.extend(run_in_threads(upload, uploads, self.workers))
+        for (abspath, relpath), exc in self.failures:
+            if relpath in cloud_objects:
+                self.update_count -= 1
+            else:
+                self.create_count -= 1
+
+    def upload_archives(self, uploads):
+        """
+        Uploads the files that need no headers of their own in gzipped tar
+        archives of up to ARCHIVE_BATCH_SIZE bytes each, which swift's
+        extract-archive middleware unpacks into the container.
+
+        Returns the uploads left to send one by one: files with their own
+        headers or TTL, files that failed to extract, and all the rest once
+        the cluster turns out not to extract archives.
+        """
+        singles = []
+        batches = []
+        batch, batch_size = [], 0
+        for abspath, relpath in uploads:
+            size = self.local_stats[relpath].st_size
+            headers = get_headers(relpath, get_content_type(relpath, None))
+            if list(headers) != ["Content-Type"] or CUMULUS["FILE_TTL"] or size > ARCHIVE_BATCH_SIZE:
+                singles.append((abspath, relpath))
+                continue
+            if batch and batch_size + size > ARCHIVE_BATCH_SIZE:
+                batches.append(batch)
+                batch, batch_size = [], 0
+            batch.append((abspath, relpath))
+            batch_size += size
+        if batch:
+            batches.append(batch)
+
+        for index, batch in enumerate(batches):
+            errors = self.storage._extract_archive(stream_tar(batch))
+            if errors is None:
+                for batch in batches[index:]:
+                    singles.extend(batch)
+                break
+            failed = set(name for name, status in errors)
+            for abspath, relpath in batch:
+                if isinstance(relpath, bytes):
+                    name = relpath.decode("utf-8")
+                else:
+                    name = relpath
+                if name in failed:
+                    singles.append((abspath, relpath))
+                    continue
+                self.upload_count += 1
+                self.uploaded[relpath] = None
+                if not self.quiet or self.verbosity > 1:
+                    print("Uploaded: {0}".format(relpath))
+        return singles
+
+    def hash_local_files(self, paths):
+        """
+        Returns a dict of MD5 hex digests keyed by relative path for the
+        given ``(relpath, abspath)`` pairs, hashed in a process pool.
+        """
+        jobs = []
+        for relpath, abspath in paths:
+            headers = get_headers(relpath, get_content_type(relpath, None))
+            jobs.append((relpath, abspath, headers.get("Content-Encoding") == "gzip"))
+        if not jobs:
+            return {}
+        pool = Pool()
+        try:
+            return dict(pool.imap_unordered(hash_file, jobs, chunksize=64))
+        finally:
+            pool.close()
+            pool.join()
 
     def upload_file(self, abspath, cloud_filename):
         """
         Uploads a file to the container.
         """
+        etag = None
         if not self.test_run:
             content = open(abspath, "rb")
             content_type = get_content_type(cloud_filename, content)
             headers = get_headers(cloud_filename, content_type)
+            size = os.stat(abspath).st_size
+            gzipped = headers.get("Content-Encoding") == "gzip"
+            if gzipped:
+                content = GzipStream(content, chunk_size=self.storage.chunk_size)
 
-            if headers.get("Content-Encoding") == "gzip":
-                content = get_gzipped_contents(content)
-                size = content.size
+            threshold = self.storage.segment_threshold
+            if threshold and size > threshold:
+                self.storage._upload_segments(cloud_filename, content, size, headers,
+                                              ttl=CUMULUS["FILE_TTL"],
+                                              path=None if gzipped else abspath)
+            elif gzipped:
+                # the compressed size is unknown, so stream it chunked
+                etag = self.storage.container.create(
+                    obj_name=cloud_filename,
+                    data=stream_content(content, self.storage.chunk_size),
+                    content_type=content_type,
+                    content_encoding="gzip",
+                    headers=headers,
+                    ttl=CUMULUS["FILE_TTL"],
+                    chunked=True,
+                ).etag
             else:
-                size = os.stat(abspath).st_size
-            self.container.create(
-                obj_name=cloud_filename,
-                data=content,
-                content_type=content_type,
-                content_length=size,
-                content_encoding=headers.get("Content-Encoding", None),
-                headers=headers,
-                ttl=CUMULUS["FILE_TTL"],
-                etag=None,
-            )
-
-        self.upload_count += 1
+                etag = self.storage.container.create(
+                    obj_name=cloud_filename,
+                    data=content,
+                    content_type=content_type,
+                    content_length=size,
+                    headers=headers,
+                    ttl=CUMULUS["FILE_TTL"],
+                    etag=None,
+                ).etag
+            content.close()
+
+        with self.lock:
+            self.upload_count += 1
+            self.uploaded[cloud_filename] = etag
         if not self.quiet or self.verbosity > 1:
             print("Uploaded: {0}".format(cloud_filename))
 
-    def delete_extra_files(self, relpaths, cloud_objs):
-        """
-        Deletes any objects from the container that do not exist locally.
-        """
-        for cloud_obj in cloud_objs:
-            if cloud_obj not in relpaths:
-                if not self.test_run:
-                    self.delete_cloud_obj(cloud_obj)
-                self.delete_count += 1
-                if not self.quiet or self.verbosity > 1:
-                    print("Deleted: {0}".format(cloud_obj))
-
-    def delete_cloud_obj(self, cloud_obj):
+    def delete_extra_files(self, local_files, cloud_objs):
         """
-        Deletes an object from the container.
+        Deletes any objects from the container that do not exist locally,
+        in bulk.
         """
-        self._connection.delete_object(
-            container=self.container_name,
-            obj=cloud_obj,
-        )
+        extra_objs = [cloud_obj for cloud_obj in cloud_objs if cloud_obj not in local_files]
+        if not self.test_run:
+            self.storage.delete_many(extra_objs)
+        self.delete_count += len(extra_objs)
+        if not self.quiet or self.verbosity > 1:
+            for cloud_obj in extra_objs:
+                print("Deleted: {0}".format(cloud_obj))
 
     def wipe_container(self):
         """
         Completely wipes out the contents of the container.
         """
+        names = list(self.index_cloud())
         if self.test_run:
-            print("Wipe would delete {0} objects.".format(len(self.container.object_count)))
+            print("Wipe would delete {0} objects.".format(len(names)))
         else:
             if not self.quiet or self.verbosity > 1:
-                print("Deleting {0} objects...".format(len(self.container.object_count)))
-            self._connection.delete_all_objects()
+                print("Deleting {0} objects...".format(len(names)))
+            self.storage.delete_many(names)
+
+    def print_failures(self):
+        """
+        Prints the files that failed to upload to stderr.
+        """
+        self.stderr.write("Failed to upload {0} files:".format(len(self.failures)))
+        for (abspath, relpath), exc in self.failures:
+            self.stderr.write("  {0}: {1}".format(relpath, exc))
 
     def print_tally(self):
         """
@@ -5,12 +5,20 @@ from django.conf import settings
 
 CUMULUS = {
     "API_KEY": None,
+    "ASSUME_CONTAINERS_EXIST": False,
+    "ASYNC_WORKERS": 16,
     "AUTH_URL": "us_authurl",
     "AUTH_VERSION": "2.0",
     "AUTH_TENANT_NAME": None,
     "AUTH_TENANT_ID": None,
     "REGION": "DFW",
+    "CHUNK_SIZE": 1048576,  # 1MB
+    "CDN_URI_CACHE": None,
+    "CDN_URL_REFRESH": 3600,
     "CNAMES": None,
+    "CONNECTION_IDLE_TIMEOUT": 60,
+    "CONNECTION_POOL_SIZE": 8,
+    "CONNECTION_POOL_TIMEOUT": 60,
     "CONTAINER": None,
     "CONTAINER_URI": None,
     "CONTAINER_SSL_URI": None,
@@ -18,23 +26,40 @@ CUMULUS = {
     "TIMEOUT": 5,
     "TTL": DEFAULT_CDN_TTL,  # 86400s (24h), pyrax default
     "USE_SSL": False,
+    "TOKEN_CACHE": None,
+    "TOKEN_CACHE_DIR": None,
     "USERNAME": None,
     "STATIC_CONTAINER": None,
     "STATIC_CONTAINER_URI": None,
     "STATIC_CONTAINER_SSL_URI": None,
+    "SEGMENT_CONTAINER": None,
+    "SEGMENT_RETRIES": 2,
+    "SEGMENT_SIZE": 104857600,  # 100MB
+    "SEGMENT_THRESHOLD": 5368709119,  # 5GB, the largest object Swift accepts
+    "SEGMENT_WORKERS": 4,
+    "SKIP_IDENTICAL_UPLOADS": False,
     "INCLUDE_LIST": [],
+    "MANIFEST_DIR": None,
+    "METADATA_CACHE": None,
+    "METADATA_CACHE_SIZE": 10000,
+    "METADATA_CACHE_TTL": 300,
     "EXCLUDE_LIST": [],
     "HEADERS": {},
     "GZIP_CONTENT_TYPES": [],
+    "GZIP_COMPRESSION_LEVEL": 6,
     "USE_PYRAX": True,
     "PYRAX_IDENTITY_TYPE": 'rackspace',
     "FILE_TTL": None,
     "FAIL_SILENTLY": True,
+    "PRELOAD_CDN_URIS": False,
+    "VERIFY_CONTAINERS": False,
     'PUBLIC': True,
     'X_ACCOUNT_META_TEMP_URL_KEY': None,
     'X_STORAGE_URL': None,
     'X_TEMP_URL_TIMEOUT': 600,
-    'X_TEMP_URL_BASE': 'https://storage101.dfw1.clouddrive.com'
+    'X_TEMP_URL_BASE': 'https://storage101.dfw1.clouddrive.com',
+    'X_TEMP_URL_WINDOW': None,
+    'X_TEMP_URL_CACHE_SIZE': 10000,
 }
 
 if hasattr(settings, "CUMULUS"):
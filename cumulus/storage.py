@@ -1,21 +1,21 @@
+import hashlib
+import json
+import logging
 import mimetypes
+import os
 import pyrax
 import re
+import threading
 import warnings
-from gzip import GzipFile
+import zlib
 import hmac
+from io import UnsupportedOperation
+from itertools import chain, islice
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
 from time import time
-try:
-    from haslib import sha1 as sha
-except:
-    import sha
-try:
-    from cStringIO import StringIO
-except ImportError:
-    try:
-        from StringIO import StringIO
-    except ImportError:
-        from io import StringIO
+from hashlib import sha1
+from urllib import quote, unquote
 
 from django.core.files.storage import Storage
 from django.core.files.base import File, ContentFile
@@ -32,12 +32,27 @@ except ImportError:
             return decorator
         return decorator(*args, **kwargs)
 
-from cumulus.authentication import Auth
+from cumulus.authentication import Auth, PooledConnection, swiftclient
+from cumulus.cache import LRUMetadataCache, get_metadata_cache
 from cumulus.settings import CUMULUS
 
 
 HEADER_PATTERNS = tuple((re.compile(p), h) for p, h in CUMULUS.get("HEADERS", {}))
 
+# the most objects swift returns from a single listing request
+LISTING_PAGE_SIZE = 10000
+# an object of a container listing
+CloudObject = namedtuple("CloudObject", ["name", "last_modified", "bytes", "hash", "content_type"])
+
+# the most objects swift's bulk middleware deletes in a single request
+BULK_DELETE_LIMIT = 10000
+# status codes of a bulk-delete request to a cluster without the middleware
+BULK_DELETE_UNSUPPORTED = (403, 404, 405, 501)
+
+CLIENT_EXCEPTIONS = (pyrax.exceptions.ClientException,)
+if swiftclient:
+    CLIENT_EXCEPTIONS += (swiftclient.exceptions.ClientException,)
+
 
 def get_content_type(name, content):
     """
@@ -90,15 +105,286 @@ def sync_headers(cloud_obj, headers=None, header_patterns=HEADER_PATTERNS):
         cloud_obj.sync_metadata()
 
 
+class GzipStream(object):
+    """
+    A read-only file-like object that gzips a previously opened file on the
+    fly, holding no more than one compressed chunk in memory.
+
+    The gzip header carries no timestamp, so the same input always gives
+    the same output.
+    """
+    def __init__(self, input_file, compresslevel=None, chunk_size=None):
+        self.input_file = input_file
+        self.compresslevel = compresslevel or CUMULUS["GZIP_COMPRESSION_LEVEL"]
+        self.chunk_size = chunk_size or CUMULUS["CHUNK_SIZE"]
+        self.seek(0)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """
+        Rewinds the stream; seeking anywhere else is not supported.
+        """
+        if offset != 0 or whence != os.SEEK_SET:
+            raise UnsupportedOperation("GzipStream can only be rewound")
+        try:
+            self.input_file.seek(0)
+        except (AttributeError, UnsupportedOperation):
+            pass
+        self._compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self._buffer = b""
+        self._finished = False
+
+    def read(self, size=-1):
+        while not self._finished and (size is None or size < 0 or len(self._buffer) < size):
+            chunk = self.input_file.read(self.chunk_size)
+            if chunk:
+                self._buffer += self._compressor.compress(chunk)
+            else:
+                self._buffer += self._compressor.flush()
+                self._finished = True
+        if size is None or size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self):
+        self.input_file.close()
+
+
 def get_gzipped_contents(input_file):
     """
     Returns a gzipped version of a previously opened file's buffer.
+
+    This holds the whole compressed file in memory; prefer uploading a
+    ``GzipStream`` directly.
+    """
+    return ContentFile(GzipStream(input_file).read())
+
+
+class CumulusStorageFile(File):
+    """
+    A lazy, read-only file for an object stored in a container.
+
+    The object's data is fetched with HTTP Range requests of ``chunk_size``
+    bytes, keeping a single chunk buffered at a time, so memory use depends
+    on the chunk size and not on the size of the object. Objects stored with
+    a gzip content-encoding are fetched whole, as their ranges would apply to
+    the compressed bytes.
+    """
+    def __init__(self, name, storage, mode="rb", chunk_size=None):
+        self.name = name
+        self.mode = mode
+        self.file = None
+        self._storage = storage
+        self._chunk_size = chunk_size or storage.chunk_size
+        self._closed = False
+        self._pos = 0
+        self._size = None
+        self._buffer = b""
+        self._buffer_start = 0
+
+    def _get_size(self):
+        if self._size is None:
+            self._fill(0)
+        return self._size
+
+    size = property(_get_size)
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def open(self, mode=None):
+        if mode is not None:
+            self.mode = mode
+        self._closed = False
+        self.seek(0)
+
+    def close(self):
+        self._closed = True
+        self._buffer = b""
+        self._buffer_start = 0
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise IOError("Negative seek position {0}".format(offset))
+        self._pos = offset
+
+    def read(self, num_bytes=None):
+        """
+        Reads at most ``num_bytes`` bytes (or the rest of the object if
+        omitted) from the current position.
+        """
+        if num_bytes is None or num_bytes < 0:
+            end = self.size
+        else:
+            end = min(self._pos + num_bytes, self.size)
+        data = []
+        while self._pos < end:
+            offset = self._pos - self._buffer_start
+            if not 0 <= offset < len(self._buffer):
+                self._fill(self._pos)
+                offset = self._pos - self._buffer_start
+                if not 0 <= offset < len(self._buffer):
+                    break
+            piece = self._buffer[offset:offset + end - self._pos]
+            data.append(piece)
+            self._pos += len(piece)
+        return b"".join(data)
+
+    def _fill(self, start):
+        """
+        Replaces the read-ahead buffer with the chunk starting at ``start``.
+        """
+        if self._size is None and start:
+            # the first response tells the size and encoding of the object
+            self._fill(0)
+        if self._size is not None and self._buffer_start == 0 and \
+                len(self._buffer) == self._size:
+            # the whole object is already buffered
+            return
+        end = start + self._chunk_size - 1
+        headers, data = self._storage._get_range(self.name, start, end)
+        content_range = headers.get("content-range")
+        if content_range and headers.get("content-encoding") == "gzip":
+            headers, data = self._storage._get_range(self.name)
+            content_range = None
+        if content_range:
+            self._size = int(content_range.rsplit("/", 1)[1])
+            self._buffer_start = start
+        else:
+            # the server sent the whole object
+            self._size = len(data)
+            self._buffer_start = 0
+        self._buffer = data
+
+
+_temp_url_cache = None
+_temp_url_cache_lock = threading.Lock()
+
+
+def get_temp_url_cache(window):
+    """
+    Returns the process wide cache of temporary URLs, by container and name,
+    whose entries last ``window`` seconds.
+    """
+    global _temp_url_cache
+    with _temp_url_cache_lock:
+        if _temp_url_cache is None:
+            _temp_url_cache = LRUMetadataCache(window, CUMULUS["X_TEMP_URL_CACHE_SIZE"])
+        return _temp_url_cache
+
+
+def check_bulk_result(result, action):
+    """
+    Raises a ``ClientException`` unless ``result``, the body of a response
+    of swift's bulk middleware, reports success. The middleware answers
+    with a 200 status and reports failures in the body.
     """
-    zbuf = StringIO()
-    zfile = GzipFile(mode="wb", compresslevel=6, fileobj=zbuf)
-    zfile.write(input_file.read())
-    zfile.close()
-    return ContentFile(zbuf.getvalue())
+    if not isinstance(result, dict):
+        raise pyrax.exceptions.ClientException(
+            502, "{0} returned an unexpected response: {1!r}".format(action, result))
+    status = result.get("Response Status") or "200"
+    errors = result.get("Errors")
+    if errors or not status.startswith("2"):
+        code = int(status[:3]) if status[:3].isdigit() else 500
+        raise pyrax.exceptions.ClientException(code, "{0} failed: {1} {2}".format(
+            action, status, errors or result.get("Response Body")))
+
+
+def is_rewindable(content):
+    """
+    Returns whether ``content`` can be read again from the start.
+    """
+    try:
+        content.seek(0)
+    except (AttributeError, UnsupportedOperation, IOError):
+        return False
+    return True
+
+
+def get_status(exc):
+    """
+    Returns the HTTP status of a pyrax or swiftclient ``ClientException``.
+    """
+    return getattr(exc, "http_status", None) or getattr(exc, "code", None)
+
+
+def stream_content(content, chunk_size, checksum=None):
+    """
+    Yields the contents of a file in pieces of at most ``chunk_size`` bytes,
+    updating the ``checksum`` hash object (if given) with each piece.
+    """
+    try:
+        content.seek(0)
+    except (AttributeError, UnsupportedOperation):
+        pass
+    while True:
+        chunk = content.read(chunk_size)
+        if not chunk:
+            break
+        if checksum is not None:
+            checksum.update(chunk)
+        yield chunk
+
+
+def stream_file_range(path, offset, length, chunk_size, checksum=None):
+    """
+    Yields ``length`` bytes of the file at ``path`` starting at ``offset``,
+    in pieces of at most ``chunk_size`` bytes, updating the ``checksum``
+    hash object (if given) with each piece.
+    """
+    with open(path, "rb") as local_file:
+        local_file.seek(offset)
+        while length > 0:
+            chunk = local_file.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            if checksum is not None:
+                checksum.update(chunk)
+            yield chunk
+
+
+def run_in_threads(func, items, workers, stop_on_error=False):
+    """
+    Calls ``func`` on each of ``items`` from a pool of ``workers`` threads.
+
+    ``items`` is consumed lazily and at most ``workers`` of them are in
+    flight at a time, so items carrying data keep memory use bounded.
+    Returns a list of ``(item, exception)`` tuples for the calls that
+    failed; with ``stop_on_error`` no new items are started after a failure.
+    """
+    failures = []
+    slots = threading.BoundedSemaphore(workers)
+
+    def call(item):
+        try:
+            func(item)
+        except Exception as exc:
+            logging.exception("Error processing %r", item)
+            failures.append((item, exc))
+        finally:
+            slots.release()
+
+    pool = ThreadPool(workers)
+    try:
+        for item in items:
+            slots.acquire()
+            if stop_on_error and failures:
+                slots.release()
+                break
+            pool.apply_async(call, (item,))
+    finally:
+        pool.close()
+        pool.join()
+    return failures
 
 
 @deconstructible
@@ -113,18 +399,58 @@ class CumulusStorage(Auth, Storage):
     ttl = CUMULUS["TTL"]
     file_ttl = CUMULUS["FILE_TTL"]
     use_ssl = CUMULUS["USE_SSL"]
+    chunk_size = CUMULUS["CHUNK_SIZE"]
+    segment_threshold = CUMULUS["SEGMENT_THRESHOLD"]
+    segment_size = CUMULUS["SEGMENT_SIZE"]
+    segment_workers = CUMULUS["SEGMENT_WORKERS"]
+    segment_retries = CUMULUS["SEGMENT_RETRIES"]
+    segment_container = CUMULUS["SEGMENT_CONTAINER"]
+    skip_identical_uploads = CUMULUS["SKIP_IDENTICAL_UPLOADS"]
 
     public = CUMULUS['PUBLIC']
     x_meta_temp_url_key = CUMULUS['X_ACCOUNT_META_TEMP_URL_KEY']
     x_storage_url = CUMULUS['X_STORAGE_URL']
     x_temp_url_timeout = CUMULUS['X_TEMP_URL_TIMEOUT']
     base_url = CUMULUS['X_TEMP_URL_BASE']
+    x_temp_url_window = CUMULUS['X_TEMP_URL_WINDOW']
 
     def _open(self, name, mode="rb"):
         """
         Returns the CumulusStorageFile.
         """
-        return ContentFile(self._get_object(name).get())
+        return CumulusStorageFile(name, self, mode)
+
+    def _get_range(self, name, start=None, end=None):
+        """
+        Fetches the bytes ``start`` to ``end`` (inclusive) of the object
+        called ``name``, or the whole object if no range is given.
+
+        Returns a 2-tuple of the response headers (with lowercase keys) and
+        the data. A range past the end of the object returns no headers
+        and no data.
+        """
+        headers = {}
+        if start is not None:
+            headers["Range"] = "bytes={0}-{1}".format(start, end)
+        if self.use_pyrax:
+            uri = u"/{0}/{1}".format(self.container_name, name)
+            try:
+                resp, data = self.connection.method_get(uri, headers=headers,
+                                                        raw_content=True)
+            except pyrax.exceptions.ClientException as exc:
+                if exc.code == 416:
+                    return {}, b""
+                raise
+            resp_headers = resp.headers
+        else:
+            try:
+                resp_headers, data = self.connection.get_object(self.container_name, name,
+                                                                headers=headers)
+            except swiftclient.exceptions.ClientException as exc:
+                if exc.http_status == 416:
+                    return {}, b""
+                raise
+        return dict((k.lower(), v) for k, v in resp_headers.items()), data
 
     def _save(self, name, content):
         """
@@ -133,45 +459,385 @@ class CumulusStorage(Auth, Storage):
         """
         content_type = get_content_type(name, content.file)
         headers = get_headers(name, content_type)
+        checksum = hashlib.md5()
+
+        size = getattr(content, "size", None)
+        rewindable = is_rewindable(content)
+        path = None
+        if headers.get("Content-Encoding") == "gzip":
+            # the compressed size is unknown, but can't be much larger
+            content = GzipStream(content, chunk_size=self.chunk_size)
+        elif hasattr(content, "temporary_file_path"):
+            # workers stream their segments from disk rather than memory
+            path = content.temporary_file_path()
+        if size and self.segment_threshold and size > self.segment_threshold:
+            self._upload_segments(name, content, size, headers, ttl=self.file_ttl, path=path)
+            self._invalidate(name)
+            return name
+
+        if self.skip_identical_uploads and rewindable:
+            # read the file twice rather than upload it when it is stored already
+            digest = hashlib.md5()
+            for chunk in stream_content(content, self.chunk_size, digest):
+                pass
+            info = self._get_object_info(name)
+            if info and info.hash == digest.hexdigest():
+                return name
+            if not info:
+                # only create the object, in case it was stored meanwhile
+                headers["If-None-Match"] = "*"
+        data = stream_content(content, self.chunk_size, checksum)
+
+        # the headers go with the upload, so the object never exists without them
+        if self.file_ttl is not None:
+            headers["X-Delete-After"] = str(self.file_ttl)
+        try:
+            etag = self._put_object(self.container_name, name, data, headers=headers)
+        except CLIENT_EXCEPTIONS as exc:
+            if "If-None-Match" not in headers or get_status(exc) != 412:
+                raise
+            # someone else stored it since the HEAD request, which only
+            # spares the upload if they stored the same content
+            self._invalidate(name)
+            info = self._get_object_info(name)
+            if info and info.hash == digest.hexdigest():
+                return name
+            raise pyrax.exceptions.UploadFailed(
+                "{0} was stored meanwhile with other content".format(name))
+        self._invalidate(name)
+
+        # the data was streamed with chunked transfer encoding, so the server
+        # couldn't check it against an ETag sent upfront
+        if etag and etag.strip('"') != checksum.hexdigest():
+            raise pyrax.exceptions.UploadFailed(
+                "Checksum mismatch uploading {0}: sent {1}, stored {2}".format(
+                    name, checksum.hexdigest(), etag))
+
+        return name
 
+    def _put_object(self, container, name, data, headers=None, query_string=None,
+                    connection=None):
+        """
+        Stores ``data`` (a string or an iterable of strings) as the object
+        ``name`` in ``container`` with a single PUT, returning its ETag.
+        """
+        headers = dict((k, v) for k, v in (headers or {}).items() if v is not None)
+        connection = connection or self.connection
         if self.use_pyrax:
-            if headers.get("Content-Encoding") == "gzip":
-                content = get_gzipped_contents(content)
-            self.connection.store_object(container=self.container_name,
-                                         obj_name=name,
-                                         data=content.read(),
-                                         content_type=content_type,
-                                         content_encoding=headers.get("Content-Encoding", None),
-                                         ttl=self.file_ttl,
-                                         etag=None)
-            # set headers/object metadata
-            self.connection.set_object_metadata(container=self.container_name,
-                                                obj=name,
-                                                metadata=headers,
-                                                prefix='',
-                                                clear=True)
+            # otherwise pyrax sends its JSON content type, rather than let
+            # swift guess one from the name
+            headers.setdefault("Content-Type", None)
+            uri = u"/{0}/{1}".format(container, name)
+            if query_string:
+                uri = u"{0}?{1}".format(uri, query_string)
+            resp, resp_body = connection.method_put(uri, data=data, headers=headers)
+            return resp.headers.get("etag")
         else:
-            # TODO gzipped content when using swift client
-            self.connection.put_object(self.container_name, name,
-                                       content, headers=headers)
+            return connection.put_object(container, name, data, headers=headers,
+                                         query_string=query_string,
+                                         chunk_size=self.chunk_size)
 
-        return name
+    def _extract_archive(self, data, archive_format="tar.gz"):
+        """
+        Uploads the archive ``data`` (a string or an iterable of strings) in
+        a single request, to be unpacked into the container by swift's
+        extract-archive middleware.
+
+        Returns a list of ``(name, status)`` tuples for the files that could
+        not be extracted, or None if the archive wasn't extracted at all
+        because the cluster lacks the middleware. The response body is only
+        available through pyrax, so with swiftclient this always returns None.
+        """
+        if not self.use_pyrax:
+            return None
+        uri = u"/{0}?extract-archive={1}".format(self.container_name, archive_format)
+        headers = {"Accept": "application/json", "Content-Type": None}
+        resp, result = self.connection.method_put(uri, data=data, headers=headers)
+        if not isinstance(result, dict) or "Number Files Created" not in result:
+            return None
+        prefix = u"/{0}/".format(self.container_name)
+        errors = []
+        for path, status in result.get("Errors") or []:
+            name = unquote(path.encode("utf-8")).decode("utf-8")
+            if name.startswith(prefix):
+                name = name[len(prefix):]
+            errors.append((name, status))
+        status = result.get("Response Status", "201")
+        if not errors and not status.startswith("2"):
+            raise pyrax.exceptions.ClientException(
+                int(status[:3]), "Extracting archive failed: {0}".format(
+                    result.get("Response Body")))
+        return errors
+
+    def _upload_segments(self, name, content, size, headers, ttl=None, path=None):
+        """
+        Uploads ``content`` as a Static Large Object.
+
+        The data is split in SEGMENT_SIZE segments, which are uploaded
+        concurrently to the segment container and then joined by a manifest
+        stored as ``name``. A segment that fails is retried on its own up to
+        SEGMENT_RETRIES times. If ``path`` is given, each worker reads its
+        segments straight from that local file; otherwise the segments are
+        read from ``content`` one after the other.
+        """
+        segment_container = self.segment_container or u"{0}_segments".format(self.container_name)
+        self.ensure_container(segment_container)
+        prefix = u"{0}/slo/{1:f}/{2}/{3}/".format(name, time(), size, self.segment_size)
+        headers = dict(headers)
+        if ttl is not None:
+            headers["X-Delete-After"] = str(ttl)
+        local = threading.local()
+        manifest = {}
+
+        def iter_segments():
+            if path:
+                for index, offset in enumerate(range(0, size, self.segment_size)):
+                    yield index, offset, min(self.segment_size, size - offset), None
+            else:
+                try:
+                    content.seek(0)
+                except (AttributeError, UnsupportedOperation):
+                    pass
+                index = offset = 0
+                while True:
+                    data = content.read(self.segment_size)
+                    if not data:
+                        break
+                    yield index, offset, len(data), data
+                    index += 1
+                    offset += len(data)
+
+        def upload_segment(segment):
+            index, offset, length, data = segment
+            if self.use_pyrax:
+                connection = self.connection
+            else:
+                # swiftclient connections can't be shared between threads
+                if not hasattr(local, "connection"):
+                    local.connection = self._create_connection()
+                connection = local.connection
+            segment_name = u"{0}{1:08d}".format(prefix, index)
+            segment_headers = {}
+            if ttl is not None:
+                segment_headers["X-Delete-After"] = str(ttl)
+            for attempt in range(self.segment_retries + 1):
+                checksum = hashlib.md5()
+                if data is None:
+                    body = stream_file_range(path, offset, length, self.chunk_size, checksum)
+                else:
+                    checksum.update(data)
+                    body = data
+                try:
+                    etag = self._put_object(segment_container, segment_name, body,
+                                            headers=segment_headers, connection=connection)
+                    if etag and etag.strip('"') != checksum.hexdigest():
+                        raise pyrax.exceptions.UploadFailed(
+                            "Checksum mismatch uploading {0}".format(segment_name))
+                    break
+                except Exception:
+                    if attempt == self.segment_retries:
+                        raise
+                    logging.warning("Retrying segment %s of %s", index, name)
+            manifest[index] = {
+                "path": u"/{0}/{1}".format(segment_container, segment_name),
+                "etag": checksum.hexdigest(),
+                "size_bytes": length,
+            }
+
+        failures = run_in_threads(upload_segment, iter_segments(), self.segment_workers,
+                                  stop_on_error=True)
+        if failures:
+            segment, exc = failures[0]
+            raise pyrax.exceptions.UploadFailed(
+                "Uploading segment {0} of {1} failed: {2}".format(segment[0], name, exc))
+        segments = [manifest[index] for index in sorted(manifest)]
+        old_segments = self._get_segments(name)
+        self._put_object(self.container_name, name, json.dumps(segments),
+                         headers=headers, query_string="multipart-manifest=put")
+        # the segments of the object this one replaced are no longer used
+        for container in set(container for container, segment_name in old_segments or []):
+            self.delete_many([segment_name for segment_container, segment_name in old_segments
+                              if segment_container == container], container)
 
     def delete(self, name):
         """
-        Deletes the specified file from the storage system.
+        Deletes the specified file from the storage system, along with its
+        segments if it was uploaded as a Static Large Object.
 
         Deleting a model doesn't delete associated files: bit.ly/12s6Oox
         """
+        self._delete_object(name)
+
+    def _get_segments(self, name, container=None, connection=None):
+        """
+        Returns the ``(container, name)`` of each segment of the object
+        ``name`` if it is a Static Large Object, an empty list if it is
+        another object, or None if it doesn't exist.
+        """
+        container = container or self.container_name
+        connection = connection or self.connection
+        query_string = "multipart-manifest=get"
         try:
-            self.connection.delete_object(self.container_name, name)
-        except pyrax.exceptions.ClientException as exc:
-            if exc.http_status == 404:
-                pass
+            if self.use_pyrax:
+                resp, body = connection.method_head(u"/{0}/{1}".format(container, name))
+                headers = resp.headers
             else:
-                raise
+                headers = connection.head_object(container, name)
+            headers = dict((k.lower(), v) for k, v in headers.items())
+            if headers.get("x-static-large-object", "").lower() != "true":
+                return []
+            if self.use_pyrax:
+                resp, manifest = connection.method_get(u"/{0}/{1}?{2}".format(
+                    container, name, query_string))
+            else:
+                resp_headers, manifest = connection.get_object(container, name,
+                                                               query_string=query_string)
+                manifest = json.loads(manifest)
+        except CLIENT_EXCEPTIONS as exc:
+            if get_status(exc) == 404:
+                return None
+            raise
         except pyrax.exceptions.NoSuchObject:
-            pass
+            return None
+        return [tuple(segment["name"].lstrip("/").split("/", 1)) for segment in manifest]
+
+    def _delete_object(self, name, connection=None, container=None):
+        """
+        Deletes the object ``name``, ignoring objects that don't exist. The
+        segments of a Static Large Object are deleted along with it.
+        """
+        container = container or self.container_name
+        connection = connection or self.connection
+        if container == self.container_name:
+            self._invalidate(name)
+        segments = self._get_segments(name, container, connection)
+        if segments is None:
+            return
+        query_string = "multipart-manifest=delete" if segments else None
+        try:
+            if self.use_pyrax:
+                uri = u"/{0}/{1}".format(container, name)
+                if query_string:
+                    uri = u"{0}?{1}".format(uri, query_string)
+                resp, result = connection.method_delete(uri, headers={"Accept": "application/json"})
+                if segments:
+                    check_bulk_result(result, u"Deleting {0}".format(name))
+            else:
+                connection.delete_object(container, name, query_string=query_string)
+        except CLIENT_EXCEPTIONS as exc:
+            if get_status(exc) != 404:
+                raise
+
+    def delete_many(self, names, container=None):
+        """
+        Deletes the specified files from the storage system, up to
+        BULK_DELETE_LIMIT of them per bulk-delete request. If the cluster
+        doesn't support bulk deletes the files are deleted one by one,
+        SEGMENT_WORKERS at a time. Files that don't exist are ignored.
+        ``names`` may be any iterable, of which only a batch is held at
+        a time.
+
+        Bulk deletes leave the segments of Static Large Objects behind; use
+        ``delete`` for those.
+        """
+        names = iter(names)
+        container = container or self.container_name
+        while True:
+            # only a batch of the names is held at a time
+            batch = list(islice(names, BULK_DELETE_LIMIT))
+            if not batch:
+                return
+            if not self._bulk_delete(batch, container):
+                self._delete_concurrently(chain(batch, names), container)
+                return
+
+    def _bulk_delete(self, names, container):
+        """
+        Deletes ``names`` from ``container`` with a single bulk-delete
+        request. Returns False if the cluster doesn't support bulk deletes:
+        it refuses the request, or takes it for an account POST and answers
+        without the middleware's report.
+        """
+        if container == self.container_name:
+            for name in names:
+                self._invalidate(name)
+        body = "\n".join(quote(u"/{0}/{1}".format(container, name).encode("utf-8"))
+                         for name in names)
+        headers = {"Accept": "application/json", "Content-Type": "text/plain"}
+        if self.use_pyrax:
+            try:
+                resp, result = self.connection.method_post("/?bulk-delete=1", data=body,
+                                                           headers=headers)
+            except pyrax.exceptions.ClientException as exc:
+                if exc.code in BULK_DELETE_UNSUPPORTED:
+                    return False
+                raise
+        else:
+            try:
+                resp_headers, result = self.connection.post_account(
+                    headers, query_string="bulk-delete", data=body)
+            except swiftclient.ClientException as exc:
+                if exc.http_status in BULK_DELETE_UNSUPPORTED:
+                    return False
+                raise
+            try:
+                result = json.loads(result)
+            except ValueError:
+                result = None
+        if not isinstance(result, dict) or "Response Status" not in result:
+            return False
+        check_bulk_result(result, "Bulk delete")
+        return True
+
+    def _delete_concurrently(self, names, container):
+        """
+        Deletes ``names`` from ``container`` one request at a time from
+        SEGMENT_WORKERS threads.
+        """
+        local = threading.local()
+
+        def delete(name):
+            if self.use_pyrax:
+                connection = self.connection
+            else:
+                # swiftclient connections can't be shared between threads
+                if not hasattr(local, "connection"):
+                    local.connection = self._create_connection()
+                connection = local.connection
+            self._delete_object(name, connection, container)
+
+        failures = run_in_threads(delete, names, self.segment_workers)
+        if failures:
+            raise failures[0][1]
+
+    def _get_object_info(self, name):
+        """
+        Returns a ``CloudObject`` describing the object ``name``, or None if
+        there is no such object. Both are kept in the METADATA_CACHE, if
+        enabled, to spare the HEAD request next time.
+        """
+        cache = get_metadata_cache()
+        if cache is not None:
+            info = cache.get(self.container_name, name)
+            if info is not None:
+                return info or None
+        cloud_obj = self._get_object(name)
+        if cloud_obj:
+            info = CloudObject(name, cloud_obj.last_modified, cloud_obj.total_bytes,
+                               cloud_obj.etag, cloud_obj.content_type)
+        else:
+            info = None
+        if cache is not None:
+            cache.set(self.container_name, name, info or False)
+        return info
+
+    def _invalidate(self, name):
+        """
+        Drops the cached metadata of the object ``name``.
+        """
+        cache = get_metadata_cache()
+        if cache is not None:
+            cache.delete(self.container_name, name)
 
     def exists(self, name):
         """
@@ -179,15 +845,15 @@ class CumulusStorage(Auth, Storage):
         exists in the storage system, or False if the name is
         available for a new file.
         """
-        return bool(self._get_object(name))
+        return bool(self._get_object_info(name))
 
     def size(self, name):
         """
         Returns the total size, in bytes, of the file specified by name.
         """
-        file_object = self._get_object(name)
-        if file_object:
-            return file_object.total_bytes
+        info = self._get_object_info(name)
+        if info:
+            return info.bytes
         else:
             return 0
 
@@ -205,55 +871,127 @@ class CumulusStorage(Auth, Storage):
         """
         Returns an absolute, temporary URL where the file's contents can be
         accessed directly by a web browser.
+
+        With X_TEMP_URL_WINDOW, the URL stays the same for the whole window
+        and is kept in a cache shared by the process.
+        """
+        expires = self._get_temp_url_expiry()
+        cache = get_temp_url_cache(self.x_temp_url_window) if self.x_temp_url_window else None
+        if cache is not None:
+            account = u"{0}/{1}".format(self.x_storage_url, self.container_name)
+            cached = cache.get(account, name)
+            if cached is not None and cached[0] == expires:
+                return cached[1]
+        url = self.temp_urls([name], expires=expires)[0]
+        if cache is not None:
+            cache.set(account, name, (expires, url))
+        return url
+
+    def _get_temp_url_expiry(self):
+        """
+        Returns the expiry of temporary URLs made now: X_TEMP_URL_TIMEOUT
+        seconds from now, rounded up to the end of the X_TEMP_URL_WINDOW
+        seconds window if set.
         """
-        method = 'GET'
         expires = int(time() + self.x_temp_url_timeout)
-        key = self.x_meta_temp_url_key
-        path = u'{0}/{1}/{2}'.format(self.x_storage_url, self.container_name, name)
-        hmac_body = u'{0}\n{1}\n{2}'.format(method, expires, path)
-        sig = hmac.new(key, hmac_body, sha).hexdigest()
-        return  u'{0}{1}?temp_url_sig={2}&temp_url_expires={3}'.format(self.base_url, path, sig,
-                                                                expires)
+        if self.x_temp_url_window:
+            expires = (expires // self.x_temp_url_window + 1) * self.x_temp_url_window
+        return expires
+
+    def temp_urls(self, names, method="GET", expires=None):
+        """
+        Returns absolute, temporary URLs for the files ``names``, in the
+        same order, allowing ``method`` requests until ``expires`` (a Unix
+        time, by default X_TEMP_URL_TIMEOUT seconds from now, rounded up
+        to the X_TEMP_URL_WINDOW).
+
+        The HMAC is keyed once and copied for each URL, and all the URLs
+        share the same expiry.
+        """
+        if expires is None:
+            expires = self._get_temp_url_expiry()
+        if not hasattr(self, "_temp_url_hmac"):
+            self._temp_url_hmac = hmac.new(self.x_meta_temp_url_key, digestmod=sha1)
+        path_prefix = u"{0}/{1}/".format(self.x_storage_url, self.container_name)
+        body_prefix = u"{0}\n{1}\n{2}".format(method, expires, path_prefix).encode("utf-8")
+        url_prefix = self.base_url + path_prefix
+        query = u"&temp_url_expires={0}".format(expires)
+        urls = []
+        for name in names:
+            signature = self._temp_url_hmac.copy()
+            signature.update(body_prefix + name.encode("utf-8"))
+            urls.append(u"{0}{1}?temp_url_sig={2}{3}".format(url_prefix, name,
+                                                            signature.hexdigest(), query))
+        return urls
+
+    def _iter_listing(self, prefix=None, delimiter=None, marker=None,
+                      page_size=LISTING_PAGE_SIZE):
+        """
+        Yields the raw entries of the container listing, fetching it one
+        page at a time after ``marker``. With a ``delimiter`` the names
+        below the next delimiter are rolled up into ``subdir`` entries.
+        """
+        while True:
+            if self.use_pyrax:
+                qs = pyrax.utils.dict_to_qs({"marker": marker, "limit": page_size,
+                                             "prefix": prefix, "delimiter": delimiter})
+                resp, page = self.connection.method_get(u"/{0}?{1}".format(self.container_name, qs))
+            else:
+                page = self.connection.get_container(self.container_name, marker=marker,
+                                                     limit=page_size, prefix=prefix,
+                                                     delimiter=delimiter)[1]
+            for entry in page:
+                yield entry
+            if len(page) < page_size:
+                return
+            marker = page[-1].get("name") or page[-1]["subdir"]
+
+    def iter_objects(self, prefix=None, marker=None, page_size=LISTING_PAGE_SIZE):
+        """
+        Yields a ``CloudObject`` for each object in the container whose name
+        starts with ``prefix``, in name order.
+
+        The listing is fetched ``page_size`` objects at a time as the
+        iterator advances, so memory use is bounded by a page however big
+        the container is. Pass the name of the last object seen as
+        ``marker`` to resume an interrupted listing after it.
+        """
+        for entry in self._iter_listing(prefix=prefix, marker=marker, page_size=page_size):
+            yield CloudObject(entry["name"], entry["last_modified"], entry["bytes"],
+                              entry["hash"], entry["content_type"])
 
     def listdir(self, path):
         """
-        Lists the contents of the specified path, returning a 2-tuple;
-        the first being an empty list of directories (not available
-        for quick-listing), the second being a list of filenames.
+        Lists the contents of the specified path, returning a 2-tuple
+        of lists; the first item being directories, the second item
+        being files.
 
-        If the list of directories is required, use the full_listdir method.
+        Only the entries directly below ``path`` are fetched, so the cost
+        depends on the size of the directory and not of the container.
         """
+        dirs = []
         files = []
         if path and not path.endswith("/"):
             path = u"{0}/".format(path)
         path_len = len(path)
-        for name in [x["name"] for x in
-                     self.connection.get_container(self.container_name, full_listing=True)[1]]:
-            files.append(name[path_len:])
-        return ([], files)
+        for entry in self._iter_listing(prefix=path or None, delimiter="/"):
+            if "subdir" in entry:
+                dirs.append(entry["subdir"][path_len:].rstrip("/"))
+            elif entry["name"][path_len:]:
+                # skipping the marker object of the directory itself
+                files.append(entry["name"][path_len:])
+        return (dirs, files)
 
     def full_listdir(self, path):
         """
         Lists the contents of the specified path, returning a 2-tuple
         of lists; the first item being directories, the second item
         being files.
+
+        Kept for backwards compatibility, ``listdir`` now lists
+        directories too.
         """
-        dirs = set()
-        files = []
-        if path and not path.endswith("/"):
-            path = u"{0}/".format(path)
-        path_len = len(path)
-        for name in [x["name"] for x in
-                     self.connection.get_container(self.container_name, full_listing=True)[1]]:
-            name = name[path_len:]
-            slash = name[1:-1].find("/") + 1
-            if slash:
-                dirs.add(name[:slash])
-            elif name:
-                files.append(name)
-        dirs = list(dirs)
-        dirs.sort()
-        return (dirs, files)
+        return self.listdir(path)
 
 
 class CumulusStaticStorage(CumulusStorage):
@@ -279,31 +1017,113 @@ class ThreadSafeCumulusStorage(CumulusStorage):
     As long as you do not pass container or cloud objects between
     threads, you will be thread safe.
 
-    Uses one connection/container per thread.
+    Each call is made on a connection checked out of a pool shared by the
+    storages of the process, so many threads reuse a few authenticated
+    connections. See CONNECTION_POOL_SIZE.
     """
-    def __init__(self, *args, **kwargs):
-        super(ThreadSafeCumulusStorage, self).__init__(*args, **kwargs)
+    def _get_connection(self):
+        if not hasattr(self, "_connection"):
+            self._connection = PooledConnection(self.connection_pool)
+        return self._connection
+
+    connection = property(_get_connection, CumulusStorage._set_connection)
 
-        import threading
-        self.local_cache = threading.local()
 
-    def _get_connection(self):
-        if not hasattr(self.local_cache, "connection"):
-            super(ThreadSafeSwiftclientStorage, self)._get_connection()
-            self.local_cache.connection = connection
+_async_pool = None
+_async_pool_lock = threading.Lock()
 
-        return self.local_cache.connection
 
-    connection = property(_get_connection, CumulusStorage._set_connection)
+def get_async_pool():
+    """
+    Returns the pool of threads, shared by the process, that runs the calls
+    of AsyncCumulusStorage.
+    """
+    global _async_pool
+    with _async_pool_lock:
+        if _async_pool is None:
+            _async_pool = ThreadPool(CUMULUS["ASYNC_WORKERS"])
+        return _async_pool
+
 
-    def _get_container(self):
-        if not hasattr(self.local_cache, "container"):
-            container = self.connection.create_container(self.container_name)
-            self.local_cache.container = container
+class AsyncCumulusStorage(ThreadSafeCumulusStorage):
+    """
+    Extends ThreadSafeCumulusStorage with non-blocking counterparts of its
+    methods, prefixed with "a".
+
+    Each call runs in a pool of ASYNC_WORKERS threads shared by the process
+    and returns at once with a ``multiprocessing.pool.AsyncResult``: its
+    ``get()`` returns the outcome or raises the error. ``callback`` (if
+    given) is called with the outcome in the worker thread that made the
+    call, before the result is ready; an error it raises is raised by
+    ``get()``. A callback holds its worker for as long as it runs, so
+    callbacks that wait for other calls can use up the ASYNC_WORKERS
+    threads. Requests are made on the pool of
+    connections of ThreadSafeCumulusStorage.
+    """
+    def _submit(self, func, args=(), callback=None):
+        if callback is not None:
+            # rather than in the single result handler thread of the pool,
+            # where a slow callback would hold up every other result
+            def call(*args):
+                result = func(*args)
+                callback(result)
+                return result
+            return get_async_pool().apply_async(call, args)
+        return get_async_pool().apply_async(func, args)
+
+    def asave(self, name, content, callback=None):
+        return self._submit(self.save, (name, content), callback)
+
+    def aopen(self, name, mode="rb", callback=None):
+        def open_file():
+            cloud_file = self.open(name, mode)
+            cloud_file.size  # fetches the first chunk
+            return cloud_file
+        return self._submit(open_file, callback=callback)
+
+    def aexists(self, name, callback=None):
+        return self._submit(self.exists, (name,), callback)
 
-        return self.local_cache.container
+    def asize(self, name, callback=None):
+        return self._submit(self.size, (name,), callback)
 
-    container = property(_get_container, CumulusStorage._set_container)
+    def adelete(self, name, callback=None):
+        return self._submit(self.delete, (name,), callback)
+
+    def alistdir(self, path, callback=None):
+        return self._submit(self.listdir, (path,), callback)
+
+    def aiter_chunks(self, name, chunk_size=None):
+        """
+        Yields the data of the object ``name`` in chunks of ``chunk_size``
+        bytes, fetching the next chunk in the pool while the current one is
+        being consumed. This is a plain generator: it blocks while it waits
+        for a chunk that hasn't arrived yet.
+
+        Objects stored with a gzip content-encoding are fetched whole, as
+        their ranges would apply to the compressed bytes.
+        """
+        chunk_size = chunk_size or self.chunk_size
+        start = 0
+        pending = self._submit(self._get_range, (name, start, start + chunk_size - 1))
+        while pending is not None:
+            headers, data = pending.get()
+            content_range = headers.get("content-range")
+            if headers.get("content-encoding") == "gzip":
+                if content_range:
+                    headers, data = self._get_range(name)
+                for offset in range(0, len(data), chunk_size):
+                    yield data[offset:offset + chunk_size]
+                return
+            # without a content-range the server sent the whole object
+            size = int(content_range.rsplit("/", 1)[1]) if content_range else len(data)
+            start += len(data)
+            if data and start < size:
+                pending = self._submit(self._get_range, (name, start, start + chunk_size - 1))
+            else:
+                pending = None
+            if data:
+                yield data
 
 
 class SwiftclientStorage(CumulusStorage):
@@ -2,3 +2,11 @@ import django
 # For compatibility with < 1.6 django testing.
 if django.get_version() < '1.6':
     from .test_storage import *  # noqa
+    from .test_syncfiles import *  # noqa
+    from .test_cache import *  # noqa
+    from .test_authentication import *  # noqa
+    from .test_context_processors import *  # noqa
+    from .test_uploads import *  # noqa
+    from .test_urls import *  # noqa
+    from .test_delete import *  # noqa
+    from .test_segments import *  # noqa
@@ -0,0 +1,23 @@
+from cumulus.storage import CumulusStorage
+
+
+class FakeResponse(object):
+    """
+    Stands in for the response pyrax returns along with the body.
+    """
+    def __init__(self, headers):
+        self.headers = headers
+
+
+def make_storage(connection, storage_class=CumulusStorage, **attrs):
+    """
+    Returns a ``storage_class`` of the container "test" making its pyrax
+    requests on the fake ``connection``, with ``attrs`` set on it.
+    """
+    storage = storage_class(container="test")
+    storage.use_pyrax = True
+    storage.file_ttl = None
+    storage.connection = connection
+    for name, value in attrs.items():
+        setattr(storage, name, value)
+    return storage
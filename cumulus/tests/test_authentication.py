@@ -0,0 +1,211 @@
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+from time import sleep
+
+import pyrax
+from django.test import SimpleTestCase
+from pyrax.exceptions import ClientException
+from pyrax.object_storage import Container
+
+from cumulus import authentication
+from cumulus.authentication import Auth, ConnectionPool, PooledConnection
+from cumulus.cache import FileTokenCache, get_token_cache
+from cumulus.settings import CUMULUS
+from cumulus.storage import CumulusStorage
+
+
+class FakeConnection(object):
+    active = 0
+    most_active = 0
+    lock = threading.Lock()
+
+    def __init__(self):
+        self.region = "DFW"
+
+    def call(self, read_body):
+        return read_body()
+
+    def slow_call(self):
+        with self.lock:
+            FakeConnection.active += 1
+            FakeConnection.most_active = max(FakeConnection.most_active, FakeConnection.active)
+        sleep(0.05)
+        with self.lock:
+            FakeConnection.active -= 1
+        return self
+
+
+class ConnectionPoolTests(SimpleTestCase):
+    def test_reuse(self):
+        pool = ConnectionPool(FakeConnection, max_size=2, idle_timeout=60)
+        with pool.connection() as first:
+            with pool.connection() as second:
+                self.assertNotEqual(first, second)
+        with pool.connection() as connection:
+            self.assertTrue(connection in (first, second))
+
+    def test_idle_timeout(self):
+        pool = ConnectionPool(FakeConnection, max_size=2, idle_timeout=0.01)
+        with pool.connection() as first:
+            pass
+        sleep(0.02)
+        with pool.connection() as connection:
+            self.assertNotEqual(connection, first)
+
+    def test_timeout(self):
+        pool = ConnectionPool(FakeConnection, max_size=1, idle_timeout=60, timeout=0.01)
+        with pool.connection():
+            self.assertRaises(ClientException, pool.checkout)
+        with pool.connection():
+            pass
+
+    def test_nested_call(self):
+        # a request consuming a body read through the same pool
+        pool = ConnectionPool(FakeConnection, max_size=1, idle_timeout=60, timeout=1)
+        connection = PooledConnection(pool)
+        self.assertEqual(connection.call(lambda: connection.region), "DFW")
+        with pool.connection():
+            pass
+
+    def test_pooled_connection(self):
+        created = []
+
+        def create_connection():
+            created.append(FakeConnection())
+            return created[-1]
+
+        connection = PooledConnection(ConnectionPool(create_connection, max_size=2,
+                                                     idle_timeout=60))
+        self.assertEqual(connection.region, "DFW")
+        FakeConnection.most_active = 0
+        threads = [threading.Thread(target=connection.slow_call) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(FakeConnection.most_active, 2)
+        self.assertEqual(len(created), 2)
+
+
+class FakePyrax(object):
+    """
+    Stands in for the pyrax module of a new process, authenticating
+    without calling the identity service.
+    """
+    create_context = staticmethod(pyrax.create_context)
+    get_setting = staticmethod(pyrax.get_setting)
+
+    def __init__(self):
+        self.identity = None
+        self.authentications = 0
+
+    def set_credentials(self, username, api_key):
+        self.authentications += 1
+        expires = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+        self.identity = self.create_context(username=username, password=api_key)
+        self.identity._parse_response({"access": {
+            "token": {"id": "token{0}".format(self.authentications),
+                      "expires": expires.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+                      "tenant": {"id": "1234", "name": "1234"}},
+            "serviceCatalog": [{"name": "cloudFiles", "type": "object-store", "endpoints": [
+                {"region": "DFW", "tenantId": "1234",
+                 "publicURL": "https://storage.example.com/v1/1234"}]}],
+            "user": {"id": "42", "name": username, "roles": []},
+        }})
+        self.identity.authenticated = True
+
+
+class TokenCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.token_dir = tempfile.mkdtemp()
+        self.saved_settings = dict((key, CUMULUS[key]) for key in ("TOKEN_CACHE", "TOKEN_CACHE_DIR"))
+        CUMULUS.update(TOKEN_CACHE="file", TOKEN_CACHE_DIR=self.token_dir)
+
+    def tearDown(self):
+        CUMULUS.update(self.saved_settings)
+        shutil.rmtree(self.token_dir)
+
+    def authenticate(self):
+        auth = Auth.__new__(Auth)
+        auth.pyrax = FakePyrax()
+        auth.username = "user"
+        auth._authenticate()
+        return auth.pyrax
+
+    def test_file_cache(self):
+        cache = FileTokenCache(os.path.join(self.token_dir, "token.json"))
+        self.assertEqual(cache.get(), None)
+        with cache.lock():
+            cache.set({"access": {"token": {"id": "a"}}}, 60)
+        self.assertEqual(cache.get(), {"access": {"token": {"id": "a"}}})
+        self.assertEqual(os.stat(cache.path).st_mode & 0o777, 0o600)
+        # a file others could have written is not trusted
+        os.chmod(cache.path, 0o644)
+        self.assertEqual(cache.get(), None)
+
+    def test_shared_dir(self):
+        self.assertNotEqual(get_token_cache("user"), None)
+        os.chmod(self.token_dir, 0o777)
+        self.assertEqual(get_token_cache("user"), None)
+
+    def test_shared_token(self):
+        first = self.authenticate()
+        self.assertEqual(first.authentications, 1)
+        # another process starts with the cached token
+        second = self.authenticate()
+        self.assertEqual(second.authentications, 0)
+        self.assertTrue(second.identity.authenticated)
+        self.assertEqual(second.identity.token, "token1")
+        self.assertEqual(second.identity.expires, first.identity.expires.replace(microsecond=0))
+        self.assertEqual(second.services, ("object_store",))
+
+
+class LazyAuthenticationTests(SimpleTestCase):
+    def setUp(self):
+        self.set_credentials = pyrax.set_credentials
+        pyrax.set_credentials = self.fail
+
+    def tearDown(self):
+        pyrax.set_credentials = self.set_credentials
+
+    def test_public_url(self):
+        storage = CumulusStorage(container="test")
+        storage.public = True
+        storage.container_uri = "http://cdn.example.com"
+        self.assertEqual(storage.url("a.txt"), "http://cdn.example.com/a.txt")
+
+
+class FakeStorageClient(object):
+    def __init__(self):
+        self._manager = FakeManager()
+        self.created = []
+
+    def create_container(self, name):
+        self.created.append(name)
+        return Container(self._manager, {"name": name})
+
+
+class FakeManager(object):
+    api = None
+
+
+class ContainerTests(SimpleTestCase):
+    def setUp(self):
+        authentication._existing_containers.discard(("DFW", "existing-test"))
+
+    def make_storage(self):
+        storage = CumulusStorage(container="existing-test")
+        storage.region = "DFW"
+        storage.connection = FakeStorageClient()
+        return storage
+
+    def test_created_once(self):
+        storage = self.make_storage()
+        self.assertEqual(storage.container.name, "existing-test")
+        self.assertEqual(storage.connection.created, ["existing-test"])
+        storage = self.make_storage()
+        self.assertEqual(storage.container.name, "existing-test")
+        self.assertEqual(storage.connection.created, [])
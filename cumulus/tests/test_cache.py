@@ -0,0 +1,42 @@
+from time import sleep
+
+from django.test import SimpleTestCase
+
+from cumulus.cache import DjangoMetadataCache, LRUMetadataCache
+from cumulus.storage import CloudObject
+
+
+class MetadataCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.info = CloudObject("a.txt", "2015-01-01T00:00:00.000000", 12,
+                                "9dd4e461268c8034f5c8564e155c67a6", "text/plain")
+
+    def test_lru(self):
+        cache = LRUMetadataCache(ttl=60, max_entries=2)
+        cache.set("c", "a.txt", self.info)
+        cache.set("c", "missing.txt", False)
+        self.assertEqual(cache.get("c", "a.txt"), self.info)
+        self.assertEqual(cache.get("other", "a.txt"), None)
+        # a.txt was used last, so adding another entry evicts missing.txt
+        cache.set("c", "b.txt", self.info)
+        self.assertEqual(cache.get("c", "missing.txt"), None)
+        self.assertEqual(cache.get("c", "a.txt"), self.info)
+        cache.delete("c", "a.txt")
+        self.assertEqual(cache.get("c", "a.txt"), None)
+
+    def test_lru_expiry(self):
+        cache = LRUMetadataCache(ttl=0.01, max_entries=2)
+        cache.set("c", "missing.txt", False)
+        self.assertEqual(cache.get("c", "missing.txt"), False)
+        sleep(0.02)
+        self.assertEqual(cache.get("c", "missing.txt"), None)
+
+    def test_django(self):
+        cache = DjangoMetadataCache(ttl=60)
+        name = u"a long name with spaces \xe9 " * 20
+        cache.set("c", name, self.info)
+        cache.set("c", "missing.txt", False)
+        self.assertEqual(cache.get("c", name), self.info)
+        self.assertEqual(cache.get("c", "missing.txt"), False)
+        cache.delete("c", name)
+        self.assertEqual(cache.get("c", name), None)
@@ -0,0 +1,78 @@
+from time import sleep
+
+from django.test import SimpleTestCase
+
+from cumulus import authentication, context_processors
+from cumulus.settings import CUMULUS
+from cumulus.storage import CumulusStorage
+
+
+class FakeStorage(object):
+    lookups = 0
+
+    def __init__(self):
+        FakeStorage.lookups += 1
+        self.container_cdn_uri = "http://cdn{0}.example.com".format(self.lookups)
+        self.container_cdn_ssl_uri = "https://cdn{0}.example.com".format(self.lookups)
+
+    def refresh_cdn_uris(self):
+        pass
+
+
+class ContainerUrlsTests(SimpleTestCase):
+    def setUp(self):
+        self.refresh = CUMULUS["CDN_URL_REFRESH"]
+        FakeStorage.lookups = 0
+        context_processors._container_urls.pop(FakeStorage, None)
+
+    def tearDown(self):
+        CUMULUS["CDN_URL_REFRESH"] = self.refresh
+        context_processors._container_urls.pop(FakeStorage, None)
+
+    def test_resolved_once(self):
+        for i in range(3):
+            urls = context_processors._get_container_urls(FakeStorage)
+        self.assertEqual(urls, ("http://cdn1.example.com", "https://cdn1.example.com"))
+        self.assertEqual(FakeStorage.lookups, 1)
+
+    def test_background_refresh(self):
+        CUMULUS["CDN_URL_REFRESH"] = 0
+        context_processors._get_container_urls(FakeStorage)
+        sleep(0.01)
+        # stale URLs are returned while they are refreshed
+        urls = context_processors._get_container_urls(FakeStorage)
+        self.assertEqual(urls[0], "http://cdn1.example.com")
+        for i in range(100):
+            if FakeStorage.lookups == 2 and not context_processors._refreshing:
+                break
+            sleep(0.01)
+        CUMULUS["CDN_URL_REFRESH"] = 3600
+        urls = context_processors._get_container_urls(FakeStorage)
+        self.assertEqual(urls[0], "http://cdn2.example.com")
+
+
+class FakeContainer(object):
+    cdn_uri = "http://cdn.example.com"
+    cdn_ssl_uri = "https://cdn.example.com"
+
+
+class CdnUriRegistryTests(SimpleTestCase):
+    def setUp(self):
+        self.key = ("DFW", "registry-test", False)
+        authentication._cdn_uris.pop(self.key, None)
+
+    def tearDown(self):
+        authentication._cdn_uris.pop(self.key, None)
+
+    def make_storage(self):
+        storage = CumulusStorage(container="registry-test")
+        storage.region = "DFW"
+        storage.container_uri = None
+        return storage
+
+    def test_shared_between_instances(self):
+        storage = self.make_storage()
+        storage._container = FakeContainer()
+        self.assertEqual(storage.url("a.txt"), "http://cdn.example.com/a.txt")
+        # another instance has no container to look the URI up in
+        self.assertEqual(self.make_storage().url("a.txt"), "http://cdn.example.com/a.txt")
@@ -0,0 +1,92 @@
+from django.test import SimpleTestCase
+from pyrax.exceptions import ClientException
+
+from cumulus import storage as cumulus_storage
+from cumulus.tests.fakes import FakeResponse, make_storage
+
+
+class FakeConnection(object):
+    """
+    Answers bulk deletes with ``bulk_result``, or refuses them with the
+    ``bulk_unsupported`` status, and records every request.
+    """
+    def __init__(self, bulk_result=None, bulk_unsupported=None):
+        self.bulk_result = bulk_result
+        self.bulk_unsupported = bulk_unsupported
+        self.bulk_deletes = []
+        self.deletes = []
+
+    def method_post(self, uri, data=None, headers=None):
+        if uri == "/?bulk-delete=1":
+            if self.bulk_unsupported:
+                raise ClientException(self.bulk_unsupported)
+            self.bulk_deletes.append(data.split("\n"))
+            return None, self.bulk_result
+
+    def method_delete(self, uri, data=None, headers=None):
+        self.deletes.append(uri)
+        return None, None
+
+    def method_head(self, uri):
+        return FakeResponse({}), None
+
+
+class FakeSwiftConnection(object):
+    """
+    A swiftclient connection to a cluster without the bulk middleware,
+    which takes bulk deletes for account POSTs.
+    """
+    def __init__(self):
+        self.deletes = []
+
+    def post_account(self, headers, query_string=None, data=None):
+        return {}, b""
+
+    def head_object(self, container, name):
+        return {}
+
+    def delete_object(self, container, name, query_string=None):
+        self.deletes.append(u"/{0}/{1}".format(container, name))
+
+
+class DeleteManyTests(SimpleTestCase):
+    def make_storage(self, **kwargs):
+        return make_storage(FakeConnection(**kwargs))
+
+    def test_batches(self):
+        storage = self.make_storage(bulk_result={"Response Status": "200 OK", "Errors": [],
+                                                 "Number Deleted": 2})
+        bulk_delete_limit = cumulus_storage.BULK_DELETE_LIMIT
+        cumulus_storage.BULK_DELETE_LIMIT = 2
+        try:
+            storage.delete_many(iter([u"a.txt", u"b c.txt", u"\xe9.txt"]))
+        finally:
+            cumulus_storage.BULK_DELETE_LIMIT = bulk_delete_limit
+        self.assertEqual(storage.connection.bulk_deletes,
+                         [["/test/a.txt", "/test/b%20c.txt"], ["/test/%C3%A9.txt"]])
+
+    def test_unsupported(self):
+        storage = self.make_storage(bulk_unsupported=405)
+        storage.delete_many(name for name in ["a.txt", "b.txt"])
+        self.assertEqual(sorted(storage.connection.deletes), ["/test/a.txt", "/test/b.txt"])
+
+    def test_no_report(self):
+        # an account POST answered without the middleware
+        storage = self.make_storage(bulk_result=None)
+        storage.delete_many(["a.txt"])
+        self.assertEqual(storage.connection.deletes, ["/test/a.txt"])
+
+    def test_swiftclient_unsupported(self):
+        connection = FakeSwiftConnection()
+        storage = make_storage(connection, use_pyrax=False, _create_connection=lambda: connection)
+        storage.delete_many(["a.txt", "b.txt"])
+        self.assertEqual(sorted(storage.connection.deletes), ["/test/a.txt", "/test/b.txt"])
+
+    def test_errors(self):
+        results = [
+            {"Response Status": "400 Bad Request", "Errors": [["/test/a.txt", "409 Conflict"]]},
+            {"Response Status": "400 Bad Request", "Errors": [], "Response Body": "Invalid bulk delete."},
+        ]
+        for result in results:
+            storage = self.make_storage(bulk_result=result)
+            self.assertRaises(ClientException, storage.delete_many, ["a.txt"])
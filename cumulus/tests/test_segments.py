@@ -0,0 +1,128 @@
+import hashlib
+import json
+from io import BytesIO
+
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.test import SimpleTestCase
+from pyrax.exceptions import ClientException, NotFound
+
+from cumulus.tests.fakes import FakeResponse, make_storage
+
+
+class FakeConnection(object):
+    """
+    Stores objects and Static Large Object manifests in memory. The PUTs
+    of names in ``fail_once`` fail the first time.
+    """
+    def __init__(self, fail_once=()):
+        self.objects = {}
+        self.manifests = {}
+        self.fail_once = set(fail_once)
+        self.puts = []
+        self.headers = {}
+        self.deletes = []
+
+    def create_container(self, name):
+        pass
+
+    def method_put(self, uri, data=None, headers=None):
+        if not isinstance(data, bytes):
+            data = b"".join(data)
+        path, _, query = uri.partition("?")
+        self.puts.append(path)
+        self.headers[path] = headers
+        if path.rsplit("/", 1)[1] in self.fail_once:
+            self.fail_once.remove(path.rsplit("/", 1)[1])
+            raise ClientException(503)
+        if query == "multipart-manifest=put":
+            self.manifests[path] = json.loads(data)
+        else:
+            self.objects[path] = data
+        return FakeResponse({"etag": hashlib.md5(data).hexdigest()}), None
+
+    def method_head(self, uri):
+        if uri in self.manifests:
+            return FakeResponse({"X-Static-Large-Object": "True"}), None
+        if uri in self.objects:
+            return FakeResponse({}), None
+        raise NotFound(404)
+
+    def method_get(self, uri):
+        path, _, query = uri.partition("?")
+        return FakeResponse({}), [{"name": segment["path"], "hash": segment["etag"],
+                                   "bytes": segment["size_bytes"]}
+                                  for segment in self.manifests[path]]
+
+    def method_post(self, uri, data=None, headers=None):
+        if uri == "/?bulk-delete=1":
+            for path in data.split("\n"):
+                self.deletes.append(path)
+                self.objects.pop(path, None)
+            return None, {"Response Status": "200 OK", "Errors": []}
+
+    def method_delete(self, uri, data=None, headers=None):
+        path, _, query = uri.partition("?")
+        self.deletes.append(path)
+        if query == "multipart-manifest=delete":
+            for segment in self.manifests.pop(path):
+                self.deletes.append(segment["path"])
+                self.objects.pop(segment["path"])
+            return None, {"Response Status": "200 OK", "Errors": []}
+        self.objects.pop(path)
+        return None, None
+
+
+class UnreadableUpload(TemporaryUploadedFile):
+    def read(self, *args):
+        raise AssertionError("the upload was read into memory")
+
+
+class SegmentTests(SimpleTestCase):
+    def setUp(self):
+        self.storage = make_storage(FakeConnection(fail_once=["00000001"]), segment_size=4,
+                                    segment_workers=2, segment_retries=1, segment_container=None)
+
+    def upload(self, data):
+        self.storage._upload_segments("big.bin", BytesIO(data), len(data), {"Content-Type": None})
+        return self.storage.connection.manifests[u"/test/big.bin"]
+
+    def test_upload(self):
+        manifest = self.upload(b"0123456789")
+        self.assertEqual([segment["size_bytes"] for segment in manifest], [4, 4, 2])
+        self.assertEqual([segment["etag"] for segment in manifest],
+                         [hashlib.md5(data).hexdigest() for data in (b"0123", b"4567", b"89")])
+        paths = [segment["path"] for segment in manifest]
+        self.assertEqual(paths, sorted(paths))
+        self.assertTrue(all(path.startswith(u"/test_segments/big.bin/slo/") for path in paths))
+        # the failed segment was uploaded again
+        self.assertEqual(self.storage.connection.puts.count(paths[1]), 2)
+        self.assertEqual(self.storage.connection.objects[paths[1]], b"4567")
+        # swift guesses the content types rather than pyrax set its own
+        for path in paths + [u"/test/big.bin"]:
+            self.assertEqual(self.storage.connection.headers[path]["Content-Type"], None)
+
+    def test_temporary_upload(self):
+        self.storage.segment_threshold = 4
+        upload = UnreadableUpload("big.bin", "application/octet-stream", 10, None)
+        upload.file.write(b"0123456789")
+        upload.file.flush()
+        self.storage._save("big.bin", upload)
+        upload.close()
+        manifest = self.storage.connection.manifests[u"/test/big.bin"]
+        self.assertEqual([self.storage.connection.objects[segment["path"]] for segment in manifest],
+                         [b"0123", b"4567", b"89"])
+
+    def test_replace(self):
+        old_paths = [segment["path"] for segment in self.upload(b"0123456789")]
+        new_paths = [segment["path"] for segment in self.upload(b"abcdef")]
+        self.assertEqual(sorted(self.storage.connection.objects), new_paths)
+        self.assertEqual(self.storage.connection.deletes, old_paths)
+
+    def test_delete(self):
+        self.upload(b"0123456789")
+        self.storage.connection.objects[u"/test/small.txt"] = b"x"
+        self.storage.delete("big.bin")
+        self.storage.delete("small.txt")
+        self.storage.delete("missing.txt")
+        self.assertEqual(self.storage.connection.objects, {})
+        self.assertEqual(self.storage.connection.manifests, {})
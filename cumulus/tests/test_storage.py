@@ -5,7 +5,7 @@ from django.core.management import call_command
 from django.test import TestCase
 
 from cumulus.settings import CUMULUS
-from cumulus.storage import CumulusStorage
+from cumulus.storage import CumulusStorage, CumulusStorageFile
 from cumulus.tests.models import StaticThing, Thing
 
 
@@ -89,8 +89,7 @@ class CumulusTests(TestCase):
         chunk = doc_file.read(4)
         self.assertEqual(chunk, 'test')
 
-        # Because of the standaard Django ContentFile behaviour in _open the
-        # situation has changed to normal python .read() behaviour.
+        # Reads continue from the current position, like python's .read().
         another_chunk = doc_file.read(3)
         self.assertEqual(another_chunk, ' co')
         self.assertNotEqual(another_chunk, 'tes')
@@ -108,6 +107,32 @@ class CumulusTests(TestCase):
         for line in custom_file:
             self.assertEqual(line, lines.pop(0))
 
+    def test_file_ranged_read(self):
+        """
+        Files are fetched lazily in chunks, seeking only moves the position.
+        """
+        storage = self.thing.document.storage
+        doc_file = CumulusStorageFile(self.thing.document.name, storage, chunk_size=5)
+        self.assertEqual(doc_file.size, 12)
+        self.assertEqual(doc_file.read(7), 'test co')
+        doc_file.seek(-3, 2)
+        self.assertEqual(doc_file.tell(), 9)
+        self.assertEqual(doc_file.read(), 'ent')
+        self.assertEqual(doc_file.read(), '')
+        self.assertEqual(list(doc_file.chunks(8)), ['test con', 'tent'])
+
+    def test_listdir(self):
+        """
+        Only the entries directly below the path are listed.
+        """
+        storage = self.thing.document.storage
+        dirs, files = storage.listdir("")
+        self.assertTrue("cumulus-tests" in dirs)
+        self.assertFalse(self.thing.document.name in files)
+        dirs, files = storage.listdir("cumulus-tests")
+        self.assertEqual(dirs, [])
+        self.assertTrue(self.thing.document.name.split("/")[-1] in files)
+
     def test_image_content_type(self):
         """
         Ensure content type is set properly for the uploaded image.
@@ -0,0 +1,227 @@
+import datetime
+import os
+import shutil
+import tarfile
+import tempfile
+from io import BytesIO
+from time import time
+from urlparse import parse_qs, urlparse
+
+from django.test import SimpleTestCase
+
+from cumulus.management.commands import syncfiles
+from cumulus.management.commands.syncfiles import Command, stream_tar
+from cumulus.settings import CUMULUS
+from cumulus.tests.fakes import make_storage
+
+
+class FakeConnection(object):
+    """
+    Serves container listings of objects holding "x".
+    """
+    def __init__(self, names, last_modified):
+        self.objects = [{"name": name, "last_modified": last_modified, "bytes": 1,
+                         "hash": "9dd4e461268c8034f5c8564e155c67a6",
+                         "content_type": "text/plain"}
+                        for name in sorted(names)]
+        self.list_calls = 0
+
+    def method_get(self, uri):
+        self.list_calls += 1
+        query = dict((k, v[0]) for k, v in parse_qs(urlparse(uri).query).items())
+        prefix = query.get("prefix", "")
+        delimiter = query.get("delimiter")
+        entries = []
+        for obj in self.objects:
+            if not obj["name"].startswith(prefix) or obj["name"] <= query.get("marker", ""):
+                continue
+            rest = obj["name"][len(prefix):]
+            if delimiter and delimiter in rest:
+                subdir = prefix + rest[:rest.index(delimiter) + 1]
+                if {"subdir": subdir} not in entries:
+                    entries.append({"subdir": subdir})
+            else:
+                entries.append(obj)
+        return None, entries[:int(query["limit"])]
+
+
+def fake_storage(names, last_modified):
+    return make_storage(FakeConnection(names, last_modified))
+
+
+class FakeArchiveStorage(object):
+    def __init__(self, errors):
+        self.errors = errors
+        self.archives = []
+
+    def _extract_archive(self, data):
+        archive = tarfile.open(fileobj=BytesIO(b"".join(data)), mode="r:gz")
+        self.archives.append(archive.getnames())
+        return self.errors
+
+
+class SyncfilesPlanningTests(SimpleTestCase):
+    """
+    Offline checks of how syncfiles plans a sync; nothing is uploaded
+    since every run is a test run.
+    """
+    def setUp(self):
+        self.file_root = tempfile.mkdtemp()
+        # other tests change these settings without restoring them
+        self.saved_settings = dict((key, CUMULUS[key])
+                                   for key in ("GZIP_CONTENT_TYPES", "HEADERS", "FILE_TTL"))
+        CUMULUS.update(GZIP_CONTENT_TYPES=[], HEADERS={}, FILE_TTL=None)
+
+    def tearDown(self):
+        CUMULUS.update(self.saved_settings)
+        shutil.rmtree(self.file_root)
+
+    def make_files(self, count):
+        for i in range(count):
+            directory = os.path.join(self.file_root, "dir{0:03d}".format(i % 100))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(os.path.join(directory, "file{0:06d}.txt".format(i)), "w") as f:
+                f.write("x")
+
+    def make_command(self):
+        command = Command()
+        with self.settings(STATIC_ROOT=self.file_root):
+            command.set_options({"syncstatic": True, "container": "test", "test_run": True,
+                                 "verbosity": 0, "includes": ["*"], "excludes": []})
+        command.verbosity = 0
+        return command
+
+    def plan(self, count):
+        """
+        Plans a test run sync against a container holding ``count`` remote
+        objects, half of which also exist locally and are up to date.
+        Returns the command and the seconds spent planning.
+        """
+        command = self.make_command()
+        names = ["dir{0:03d}/file{1:06d}.txt".format(i % 100, i)
+                 for i in range(0, count * 2, 2)]
+        later = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+        command.storage = fake_storage(names, later.strftime("%Y-%m-%dT%H:%M:%S.%f"))
+
+        start = time()
+        abspaths = command.match_local(command.file_root, command.includes, command.excludes)
+        local_files = command.index_local(abspaths)
+        cloud_objects = command.index_cloud()
+        cloud_objs = command.match_cloud(command.includes, command.excludes, cloud_objects)
+        command.upload_files(local_files, cloud_objects)
+        command.delete_extra_files(local_files, cloud_objs)
+        return command, time() - start
+
+    def test_plan_counts(self):
+        self.make_files(10)
+        command, elapsed = self.plan(10)
+        self.assertEqual(command.skip_count, 5)
+        self.assertEqual(command.create_count, 5)
+        self.assertEqual(command.upload_count, 5)
+        self.assertEqual(command.delete_count, 5)
+
+    def test_plan_compare_hash(self):
+        self.make_files(4)
+        command = self.make_command()
+        command.compare = "hash"
+        # hashes match but the cloud copies look older than the local files
+        names = ["dir{0:03d}/file{0:06d}.txt".format(i) for i in range(4)]
+        command.storage = fake_storage(names, "2000-01-01T00:00:00.000000")
+        with open(os.path.join(self.file_root, names[0]), "w") as f:
+            f.write("changed")
+        local_files = command.index_local(command.match_local(command.file_root, ["*"], []))
+        command.upload_files(local_files, command.index_cloud())
+        self.assertEqual(command.skip_count, 3)
+        self.assertEqual(command.update_count, 1)
+
+    def test_manifest(self):
+        self.make_files(4)
+        names = ["dir{0:03d}/file{0:06d}.txt".format(i) for i in range(4)]
+        command = self.make_command()
+        command.compare = "hash"
+        command.storage = fake_storage(names, "2000-01-01T00:00:00.000000")
+        local_files = command.index_local(command.match_local(command.file_root, ["*"], []))
+        cloud_objects = command.index_cloud()
+        command.upload_files(local_files, cloud_objects)
+        command.save_manifest(local_files, cloud_objects)
+
+        # the next run trusts the manifest instead of listing the container
+        with open(os.path.join(self.file_root, names[0]), "w") as f:
+            f.write("changed")
+        command = self.make_command()
+        command.compare = "hash"
+        command.storage = fake_storage(names, "2000-01-01T00:00:00.000000")
+        command.manifest = command.load_manifest()
+        local_files = command.index_local(command.match_local(command.file_root, ["*"], []))
+        self.assertEqual(sorted(local_files), names)
+        command.upload_files(local_files, command.index_manifest())
+        self.assertEqual(command.storage.connection.list_calls, 0)
+        self.assertEqual(command.skip_count, 3)
+        self.assertEqual(command.update_count, 1)
+
+        command.rebuild_manifest = True
+        self.assertEqual(command.load_manifest(), {})
+
+    def test_upload_archives(self):
+        self.make_files(5)
+        names = ["dir{0:03d}/file{0:06d}.txt".format(i) for i in range(5)]
+        command = self.make_command()
+        command.test_run = False
+        command.storage = FakeArchiveStorage([(u"dir001/file000001.txt", "400 Bad Request")])
+        archive_batch_size = syncfiles.ARCHIVE_BATCH_SIZE
+        syncfiles.ARCHIVE_BATCH_SIZE = 3
+        try:
+            uploads = []
+            for name in names:
+                abspath = os.path.join(self.file_root, name)
+                command.local_stats[name] = os.stat(abspath)
+                uploads.append((abspath, name))
+            singles = command.upload_archives(uploads)
+        finally:
+            syncfiles.ARCHIVE_BATCH_SIZE = archive_batch_size
+        self.assertEqual(command.storage.archives, [names[:3], names[3:]])
+        self.assertEqual(singles, [uploads[1]])
+        self.assertEqual(command.upload_count, 4)
+
+    def test_stream_tar(self):
+        self.make_files(2)
+        names = ["dir{0:03d}/file{0:06d}.txt".format(i) for i in range(2)]
+        data = b"".join(stream_tar((os.path.join(self.file_root, name), name) for name in names))
+        archive = tarfile.open(fileobj=BytesIO(data), mode="r:gz")
+        self.assertEqual(archive.getnames(), names)
+        self.assertEqual(archive.extractfile(names[1]).read(), b"x")
+
+    def test_iter_objects(self):
+        storage = fake_storage(["a", "b", "c", "d", "e"], "2015-01-01T00:00:00.000000")
+        cloud_objs = list(storage.iter_objects(page_size=2))
+        self.assertEqual([cloud_obj.name for cloud_obj in cloud_objs], ["a", "b", "c", "d", "e"])
+        self.assertEqual(cloud_objs[2].bytes, 1)
+        self.assertEqual(storage.connection.list_calls, 3)
+        # resume after the last object seen
+        cloud_objs = storage.iter_objects(marker="c", page_size=2)
+        self.assertEqual([cloud_obj.name for cloud_obj in cloud_objs], ["d", "e"])
+
+    def test_listdir(self):
+        storage = fake_storage(["a", "dir/", "dir/b", "dir/sub/c"], "2015-01-01T00:00:00.000000")
+        self.assertEqual(storage.listdir(""), (["dir"], ["a"]))
+        # the directory marker object isn't listed as a file
+        self.assertEqual(storage.listdir("dir"), (["sub"], ["b"]))
+        self.assertEqual(storage.full_listdir("dir/"), (["sub"], ["b"]))
+
+    def test_plan_scales_linearly(self):
+        """
+        Planning ten times as many files should take roughly ten times as
+        long, not a hundred; the ratio allows plenty of slack for noise.
+        """
+        small, large = 1000, 10000
+        self.make_files(small)
+        elapsed_small = min(self.plan(small)[1] for _ in range(3))
+        shutil.rmtree(self.file_root)
+        os.makedirs(self.file_root)
+        self.make_files(large)
+        command, elapsed_large = self.plan(large)
+        self.assertEqual(command.skip_count + command.create_count, large)
+        self.assertTrue(elapsed_large < elapsed_small * 30,
+                        "planning {0} files took {1:.2f}s, {2} files took {3:.2f}s".format(
+                            small, elapsed_small, large, elapsed_large))
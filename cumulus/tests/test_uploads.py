@@ -0,0 +1,150 @@
+import hashlib
+
+from django.core.files.base import ContentFile
+from django.test import SimpleTestCase
+from pyrax.exceptions import ClientException, UploadFailed
+
+from cumulus.settings import CUMULUS
+from cumulus.storage import AsyncCumulusStorage, CloudObject, CumulusStorage
+from cumulus.tests.fakes import FakeResponse, make_storage
+
+
+class FakeConnection(object):
+    """
+    Stores uploads in memory, refusing to overwrite objects when asked
+    to with ``If-None-Match: *``. Objects in ``gzipped`` are served like
+    requests decodes gzip content-encoded responses: whole, or cut short
+    for ranges.
+    """
+    def __init__(self, objects=None, gzipped=()):
+        self.objects = objects or {}
+        self.gzipped = gzipped
+        self.puts = []
+        self.gets = []
+
+    def method_get(self, uri, headers=None, raw_content=False):
+        self.gets.append(headers.get("Range"))
+        data = self.objects[uri]
+        resp_headers = {}
+        if uri in self.gzipped:
+            resp_headers["content-encoding"] = "gzip"
+        if "Range" in headers:
+            start, end = [int(i) for i in headers["Range"][len("bytes="):].split("-")]
+            if start >= len(data):
+                raise ClientException(416)
+            end = min(end, len(data) - 1)
+            resp_headers["content-range"] = "bytes {0}-{1}/{2}".format(start, end, len(data))
+            data = data[start:end + 1]
+            if uri in self.gzipped:
+                data = data[:len(data) // 2]
+        return FakeResponse(resp_headers), data
+
+    def method_put(self, uri, data=None, headers=None):
+        self.puts.append((uri, headers))
+        if headers.get("If-None-Match") == "*" and uri in self.objects:
+            raise ClientException(412)
+        self.objects[uri] = b"".join(data)
+        return FakeResponse({"etag": hashlib.md5(self.objects[uri]).hexdigest()}), None
+
+
+class FakeStorage(CumulusStorage):
+    def _get_object_info(self, name):
+        data = self.stored.get(u"/{0}/{1}".format(self.container_name, name))
+        if data is None:
+            return None
+        return CloudObject(name, None, len(data), hashlib.md5(data).hexdigest(), "text/css")
+
+
+class FakeAsyncStorage(FakeStorage, AsyncCumulusStorage):
+    pass
+
+
+class UploadTestCase(SimpleTestCase):
+    def setUp(self):
+        # other tests change these settings without restoring them
+        self.saved_settings = dict((key, CUMULUS[key]) for key in ("GZIP_CONTENT_TYPES", "HEADERS"))
+        CUMULUS.update(GZIP_CONTENT_TYPES=[], HEADERS={})
+
+    def tearDown(self):
+        CUMULUS.update(self.saved_settings)
+
+
+class UploadTests(UploadTestCase):
+    def make_storage(self, objects=None, skip_identical_uploads=False):
+        return make_storage(FakeConnection(objects), FakeStorage,
+                            skip_identical_uploads=skip_identical_uploads,
+                            stored={} if objects is None else dict(objects))
+
+    def test_headers_in_put(self):
+        storage = self.make_storage()
+        storage.file_ttl = 60
+        storage._save("a.css", ContentFile(b"body{}"))
+        self.assertEqual(storage.connection.puts,
+                         [(u"/test/a.css", {"Content-Type": "text/css", "X-Delete-After": "60"})])
+
+    def test_unknown_content_type(self):
+        storage = self.make_storage()
+        storage._save("LICENSE", ContentFile(b"BSD"))
+        self.assertEqual(storage.connection.puts, [(u"/test/LICENSE", {"Content-Type": None})])
+
+    def test_skip_identical(self):
+        storage = self.make_storage({u"/test/a.css": b"body{}"}, skip_identical_uploads=True)
+        storage._save("a.css", ContentFile(b"body{}"))
+        self.assertEqual(storage.connection.puts, [])
+        storage._save("a.css", ContentFile(b"body{color:red}"))
+        self.assertEqual(storage.connection.objects[u"/test/a.css"], b"body{color:red}")
+        self.assertFalse("If-None-Match" in storage.connection.puts[0][1])
+
+    def test_create_only(self):
+        storage = self.make_storage(skip_identical_uploads=True)
+        storage._save("a.css", ContentFile(b"body{}"))
+        self.assertEqual(storage.connection.puts[0][1]["If-None-Match"], "*")
+        storage.stored = storage.connection.objects
+
+        def stored_meanwhile(name):
+            # stored by someone else after the HEAD request
+            del storage._get_object_info
+            return None
+
+        # that is fine if it is the same content
+        storage._get_object_info = stored_meanwhile
+        storage._save("a.css", ContentFile(b"body{}"))
+        storage._get_object_info = stored_meanwhile
+        self.assertRaises(UploadFailed, storage._save, "a.css", ContentFile(b"body{color:red}"))
+        self.assertEqual(storage.connection.objects[u"/test/a.css"], b"body{}")
+
+
+class AsyncStorageTests(UploadTestCase):
+    def setUp(self):
+        super(AsyncStorageTests, self).setUp()
+        connection = FakeConnection({u"/test/a.txt": b"0123456789",
+                                     u"/test/a.css": b"body{color:red}"},
+                                    gzipped=[u"/test/a.css"])
+        self.storage = make_storage(connection, FakeAsyncStorage, stored=connection.objects)
+
+    def test_iter_chunks(self):
+        self.assertEqual(list(self.storage.aiter_chunks("a.txt", chunk_size=4)),
+                         [b"0123", b"4567", b"89"])
+        self.assertEqual(list(self.storage.aiter_chunks("a.txt", chunk_size=5)),
+                         [b"01234", b"56789"])
+        # the whole object fits the first chunk, so no more requests are made
+        self.storage.connection.gets = []
+        self.assertEqual(list(self.storage.aiter_chunks("a.txt", chunk_size=20)), [b"0123456789"])
+        self.assertEqual(len(self.storage.connection.gets), 1)
+
+    def test_iter_gzipped_chunks(self):
+        self.assertEqual(list(self.storage.aiter_chunks("a.css", chunk_size=8)),
+                         [b"body{col", b"or:red}"])
+
+    def test_save(self):
+        result = self.storage.asave("b.txt", ContentFile(b"x"))
+        self.assertEqual(result.get(), "b.txt")
+        self.assertEqual(self.storage.connection.objects[u"/test/b.txt"], b"x")
+
+    def test_callback(self):
+        # the callback runs in its worker, where waiting for another call is fine
+        sizes = []
+        result = self.storage.aexists("a.txt", callback=lambda exists: sizes.append(
+            self.storage.asize("a.txt").get(timeout=5)))
+        self.assertTrue(result.get(timeout=5))
+        self.assertEqual(sizes, [10])
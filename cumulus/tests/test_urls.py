@@ -0,0 +1,45 @@
+import hmac
+from hashlib import sha1
+from time import time
+from urlparse import parse_qs, urlparse
+
+from django.test import SimpleTestCase
+
+from cumulus.storage import CumulusStorage
+
+
+class TempUrlTests(SimpleTestCase):
+    def setUp(self):
+        self.storage = CumulusStorage(container="test")
+        self.storage.public = False
+        self.storage.x_meta_temp_url_key = "secret"
+        self.storage.x_storage_url = "/v1/AUTH_account"
+        self.storage.base_url = "https://storage.example.com"
+
+    def check_signature(self, url, method="GET"):
+        parsed = urlparse(url)
+        query = dict((k, v[0]) for k, v in parse_qs(parsed.query).items())
+        body = u"{0}\n{1}\n{2}".format(method, query["temp_url_expires"], parsed.path)
+        self.assertEqual(query["temp_url_sig"], hmac.new("secret", body, sha1).hexdigest())
+        return int(query["temp_url_expires"])
+
+    def test_temp_urls(self):
+        urls = self.storage.temp_urls(["a.jpg", "b.jpg"], method="PUT", expires=1500000000)
+        self.assertEqual([urlparse(url).path for url in urls],
+                         ["/v1/AUTH_account/test/a.jpg", "/v1/AUTH_account/test/b.jpg"])
+        for url in urls:
+            self.assertEqual(self.check_signature(url, "PUT"), 1500000000)
+
+    def test_url(self):
+        url = self.storage.url("a.jpg")
+        self.assertTrue(url.startswith("https://storage.example.com/v1/AUTH_account/test/a.jpg?"))
+        self.check_signature(url)
+
+    def test_url_window(self):
+        self.storage.x_temp_url_timeout = 600
+        self.storage.x_temp_url_window = 600
+        url = self.storage.url("a.jpg")
+        expires = self.check_signature(url)
+        self.assertEqual(expires % 600, 0)
+        self.assertTrue(600 <= expires - time() <= 1200)
+        self.assertEqual(self.storage.url("a.jpg"), url)